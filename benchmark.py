@@ -0,0 +1,342 @@
+import os
+import sys
+import json
+import shutil
+import resource
+import subprocess
+from argparse import ArgumentParser
+from datetime import datetime
+from time import monotonic
+from beartype import beartype
+
+import fake_cluster
+import fake_kubernetes_api
+import network_test
+
+
+DEFAULT_POD_COUNTS: list[int] = [1, 2, 4, 16, 64]
+RESULTS_DIRECTORY: str = "benchmark_results"
+WORK_DIRECTORY: str = os.path.join(".sfcompute", "benchmark")
+RESULT_PREFIX: str = "BENCHMARK RESULT: "
+
+# a run counts as a regression if it is this much slower or spawns this many more processes than the previous results
+REGRESSION_THRESHOLD: float = 1.2
+
+# which backend setup.py talks to the cluster with, "api" talks to fake_kubernetes_api.py's stub server
+KUBERNETES_BACKEND_VARIABLE: str = "BENCHMARK_KUBERNETES_BACKEND"
+# how setup.py runs commands on the pods, "ssh" or "kubectl-exec"
+TRANSPORT_VARIABLE: str = "BENCHMARK_TRANSPORT"
+# if set, setup.py also runs its network test with measurements this long, and its results are checked
+NETWORK_TEST_SECONDS_VARIABLE: str = "BENCHMARK_NETWORK_TEST_SECONDS"
+
+
+@beartype
+def create_git_repo(directory: str) -> None:
+    """
+    A bare repo at `directory`/owner/repo with a uv.lock, which the fake pods clone over file://.
+    """
+
+    source_directory = os.path.join(directory, "source")
+    os.makedirs(source_directory)
+    with open(os.path.join(source_directory, "uv.lock"), "w") as f:
+        f.write("version = 1\n")
+    with open(os.path.join(source_directory, "README.md"), "w") as f:
+        f.write("fake repo\n")
+    for command in [
+        ["git", "init", "-q", "-b", "main"],
+        ["git", "add", "."],
+        ["git", "-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", "commit", "-q", "-m", "fake repo"],
+        ["git", "clone", "-q", "--bare", ".", os.path.join(directory, "owner", "repo")],
+    ]:
+        subprocess.run(command, cwd=source_directory, check=True)
+
+
+@beartype
+def check_network_test_results() -> None:
+    """
+    The fake pods reach each other on localhost and run the fake all_reduce_perf, so the interface and the
+    all_reduce_perf bandwidth are known, and the environment must be the one chosen from the measured links.
+    """
+
+    with open(network_test.RESULTS_FILENAME) as f:
+        results = json.load(f)
+    links = {link["source"]: link for link in results["links"]}
+    for pod_name, pod_results in results["pods"].items():
+        link = links[pod_name]
+        assert None not in [link["single_stream_gbps"], link["multi_stream_gbps"], link["latency_us"]], (
+            f"The network test did not parse the link from {pod_name}: {link}"
+        )
+        assert pod_results["nccl_tests_bus_bandwidth"] == fake_cluster.ALL_REDUCE_PERF_BUS_BANDWIDTH, (
+            f"Parsed an all_reduce_perf bus bandwidth of {pod_results['nccl_tests_bus_bandwidth']} on {pod_name}, expected {fake_cluster.ALL_REDUCE_PERF_BUS_BANDWIDTH}."
+        )
+        n_threads, n_sockets_per_thread = network_test.select_socket_threads(
+            link["single_stream_gbps"], link["multi_stream_gbps"]
+        )
+        expected_environment = {
+            "NCCL_SOCKET_IFNAME": "lo",
+            "GLOO_SOCKET_IFNAME": "lo",
+            "NCCL_SOCKET_NTHREADS": str(n_threads),
+            "NCCL_NSOCKS_PERTHREAD": str(n_sockets_per_thread),
+        }
+        assert pod_results["environment"] == expected_environment, (
+            f"The network test chose {pod_results['environment']} on {pod_name}, expected {expected_environment}."
+        )
+        environment_filename = network_test.ENVIRONMENT_FILENAME.replace("$HOME", fake_cluster.get_pod_home(pod_name))
+        with open(environment_filename, "rb") as f:
+            assert f.read() == network_test.get_environment_file_content(expected_environment), (
+                f"{environment_filename} does not have the environment chosen for {pod_name}."
+            )
+
+
+@beartype
+def check_monitor_parsers() -> None:
+    """
+    monitor.py's parsers on the sample outputs of fake_cluster.py, and its outliers on pods which only differ by the
+    idle gpu of the sample.
+    """
+
+    import monitor
+
+    gpus = monitor.parse_nvidia_smi(fake_cluster.NVIDIA_SMI_OUTPUT.splitlines())
+    assert [gpu.index for gpu in gpus] == list(range(8)), f"Parsed the gpus {gpus} from the nvidia-smi sample."
+    assert [gpu.utilization_percent for gpu in gpus] == [97, 95, 0, 96, 94, 97, 93, 96]
+    assert gpus[0].memory_used_bytes == 71234 * 2**20 and gpus[0].memory_total_bytes == 81559 * 2**20
+    # [N/A] and [Not Supported]
+    assert gpus[6].power_watts is None and gpus[0].power_watts == 612.48
+    assert gpus[2].temperature_celsius == 0.0
+
+    disks = monitor.parse_df(fake_cluster.DF_OUTPUT.splitlines())
+    assert disks == {
+        "/dev/shm": monitor.DiskSample(size_bytes=68719476736, used_bytes=12884901888),
+        "/data": monitor.DiskSample(size_bytes=3936818520064, used_bytes=412316860416),
+    }, f"Parsed the disks {disks} from the df sample."
+
+    def get_row(pod_name: str, pod_gpus: list[monitor.GpuSample]) -> dict[str, float | int | str | None]:
+        sample = monitor.PodSample(
+            time=0.0,
+            pod_name=pod_name,
+            gpus=pod_gpus,
+            load_1m=1.0,
+            cpu_busy_jiffies=0,
+            cpu_total_jiffies=0,
+            memory_total_bytes=2**40,
+            memory_available_bytes=2**39,
+            disks=disks,
+        )
+        return monitor.get_row(sample, None)
+
+    busy_gpus = [gpu for gpu in gpus if gpu.utilization_percent > 0]
+    rows = {f"pod-{i}": get_row(f"pod-{i}", busy_gpus) for i in range(3)} | {"pod-3": get_row("pod-3", gpus)}
+    assert rows["pod-3"]["gpu_power_watts"] == sum(gpu.power_watts for gpu in gpus if gpu.power_watts is not None)
+    outliers = monitor.find_outliers(rows)
+    assert outliers == {"pod-0": set(), "pod-1": set(), "pod-2": set(), "pod-3": {"gpu_min_utilization_percent"}}, (
+        f"Found the outliers {outliers}, expected only the pod with an idle gpu."
+    )
+
+
+@beartype
+def run_one(n_pods: int, directory: str) -> dict:
+    """
+    Runs setup.py's main end to end against `n_pods` fake pods, in the current process.
+    The fake executables' configuration is read from the environment.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    directory = os.path.abspath(directory)
+    os.environ[fake_cluster.STATE_DIRECTORY_VARIABLE] = directory
+    bin_directory = fake_cluster.install_fake_executables(directory)
+    os.environ[fake_cluster.BIN_DIRECTORY_VARIABLE] = bin_directory
+    os.environ["PATH"] = bin_directory + ":" + os.environ["PATH"]
+
+    create_git_repo(os.path.join(directory, "git"))
+    # also keeps the api backend from ever talking to a real cluster
+    os.environ["KUBECONFIG"] = fake_kubernetes_api.serve_fake_kubernetes_api(directory)
+
+    # setup.py keeps its state relative to the working directory
+    os.chdir(directory)
+    import setup
+    import port_forward
+
+    network_test_seconds = os.environ.get(NETWORK_TEST_SECONDS_VARIABLE, "")
+    start_time = monotonic()
+    error: str | None = None
+    try:
+        setup.main(
+            kubernetes_config_filename=None,
+            github_repo="owner/repo",
+            github_branch=None,
+            github_username=None,
+            github_password_or_token=None,
+            username_on_sf_compute_machine="benchmark",
+            max_concurrency=setup.DEFAULT_MAX_CONCURRENCY,
+            git_server_url=f"file://{directory}/git",
+            n_pods=n_pods,
+            pod_name_prefix="fake-pod",
+            pod_template_parameters=setup.PodTemplateParameters(
+                gpus_per_pod=int(fake_cluster.get_configuration(fake_cluster.GPUS_PER_POD_VARIABLE))
+            ),
+            kubernetes_backend_name=os.environ.get(KUBERNETES_BACKEND_VARIABLE, "api"),
+            transport=os.environ.get(TRANSPORT_VARIABLE, "ssh"),
+            network_test_seconds=float(network_test_seconds) if network_test_seconds != "" else None,
+        )
+        # with a single pod, there is no network test
+        if network_test_seconds != "" and n_pods >= 2:
+            check_network_test_results()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"[:2000]
+    wall_seconds = monotonic() - start_time
+    port_forward.stop_port_forward_supervisor()
+
+    return {
+        "pods": n_pods,
+        "succeeded": error is None,
+        "error": error,
+        "wall_seconds": wall_seconds,
+        "spawns": fake_cluster.count_spawns(directory),
+        # ru_maxrss is in kilobytes on linux
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_child_memory_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+@beartype
+def run_in_subprocess(n_pods: int, directory: str, configuration: dict[str, str]) -> dict:
+    """
+    Each run gets its own process, so that peak memory and setup.py's global state are per run.
+    The output of setup.py goes to `directory`/setup.log.
+    """
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    log_filename = os.path.join(directory, "setup.log")
+    with open(log_filename, "w") as log_file:
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-one", str(n_pods), "--work-directory", directory],
+            env={**os.environ, **configuration},
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+        )
+    with open(log_filename) as f:
+        results = [line.removeprefix(RESULT_PREFIX) for line in f if line.startswith(RESULT_PREFIX)]
+    assert len(results) == 1, (
+        f"The benchmark with {n_pods} pods exited with code {process.returncode} without a result. See {log_filename}."
+    )
+    return json.loads(results[0])
+
+
+@beartype
+def load_previous_results(results_directory: str, configuration: dict[str, str]) -> dict[int, dict]:
+    """
+    The results of the most recent previous benchmark with the same configuration, by number of pods.
+    """
+
+    if not os.path.isdir(results_directory):
+        return {}
+    for filename in sorted(os.listdir(results_directory), reverse=True):
+        with open(os.path.join(results_directory, filename)) as f:
+            previous = json.load(f)
+        if previous["configuration"] == configuration:
+            return {result["pods"]: result for result in previous["results"]}
+    return {}
+
+
+@beartype
+def format_results(results: list[dict], previous_results: dict[int, dict]) -> tuple[str, bool]:
+    """
+    Returns a table of the results and whether any of them regressed compared to the previous ones.
+    """
+
+    lines: list[str] = [
+        f"{'PODS':>5} {'WALL':>9} {'SPAWNS':>7} {'SSH':>6} {'PEAK MB':>8} {'CHILD MB':>9}  VS PREVIOUS"
+    ]
+    regressed = False
+    for result in results:
+        n_spawns = sum(result["spawns"].values())
+        comparison = ""
+        previous = previous_results.get(result["pods"])
+        if previous is not None and previous["succeeded"]:
+            wall_ratio = result["wall_seconds"] / max(previous["wall_seconds"], 1e-9)
+            spawn_ratio = n_spawns / max(sum(previous["spawns"].values()), 1)
+            comparison = f"WALL x{wall_ratio:.2f} SPAWNS x{spawn_ratio:.2f}"
+            if wall_ratio > REGRESSION_THRESHOLD or spawn_ratio > REGRESSION_THRESHOLD:
+                comparison += " REGRESSION"
+                regressed = True
+        if not result["succeeded"]:
+            comparison = f"FAILED: {result['error'][:200]}"
+            regressed = True
+        lines.append(
+            f"{result['pods']:>5} {result['wall_seconds']:8.1f}s {n_spawns:>7} {result['spawns'].get('ssh', 0):>6} {result['peak_memory_mb']:8.0f} {result['peak_child_memory_mb']:9.0f}  {comparison}"
+        )
+    return "\n".join(lines), regressed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark setup.py end to end against simulated pods, without a cluster."
+    )
+    parser.add_argument("--pods", type=int, nargs="+", default=DEFAULT_POD_COUNTS)
+    parser.add_argument("--latency-seconds", type=float, default=0.05, help="Latency of every ssh, kubectl and sf call.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability that an ssh command fails.")
+    parser.add_argument("--output-bytes", type=int, default=100_000, help="How much output uv sync prints on each pod.")
+    parser.add_argument("--uv-sync-seconds", type=float, default=1.0)
+    parser.add_argument("--venv-megabytes", type=float, default=1.0)
+    parser.add_argument("--pod-start-seconds", type=float, default=2.0)
+    parser.add_argument("--kubernetes-backend", choices=["api", "kubectl"], default="api")
+    parser.add_argument("--transport", choices=["ssh", "kubectl-exec"], default="ssh")
+    parser.add_argument(
+        "--network-test-seconds",
+        type=float,
+        default=None,
+        help="Also run setup.py's --network-test with measurements this long, and check its results against the fake pods.",
+    )
+    parser.add_argument("--results-directory", type=str, default=RESULTS_DIRECTORY)
+    parser.add_argument("--work-directory", type=str, default=WORK_DIRECTORY)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--run-one", type=int, default=None, help="Internal: run a single benchmark in this process.")
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        print(RESULT_PREFIX + json.dumps(run_one(args.run_one, args.work_directory)), flush=True)
+        sys.exit(0)
+
+    configuration: dict[str, str] = {
+        fake_cluster.LATENCY_SECONDS_VARIABLE: str(args.latency_seconds),
+        fake_cluster.FAILURE_RATE_VARIABLE: str(args.failure_rate),
+        fake_cluster.OUTPUT_BYTES_VARIABLE: str(args.output_bytes),
+        fake_cluster.UV_SYNC_SECONDS_VARIABLE: str(args.uv_sync_seconds),
+        fake_cluster.VENV_MEGABYTES_VARIABLE: str(args.venv_megabytes),
+        fake_cluster.POD_START_SECONDS_VARIABLE: str(args.pod_start_seconds),
+        KUBERNETES_BACKEND_VARIABLE: args.kubernetes_backend,
+        TRANSPORT_VARIABLE: args.transport,
+    }
+    # left out otherwise, so that the results without the network test compare with the earlier ones
+    if args.network_test_seconds is not None:
+        configuration[NETWORK_TEST_SECONDS_VARIABLE] = str(args.network_test_seconds)
+    previous_results = load_previous_results(args.results_directory, configuration)
+    check_monitor_parsers()
+
+    results: list[dict] = []
+    for n_pods in args.pods:
+        print(f"=== BENCHMARKING WITH {n_pods} PODS ===", flush=True)
+        results.append(
+            run_in_subprocess(
+                n_pods,
+                os.path.abspath(os.path.join(args.work_directory, f"{n_pods}_pods")),
+                configuration,
+            )
+        )
+
+    table, regressed = format_results(results, previous_results)
+    print(table)
+
+    os.makedirs(args.results_directory, exist_ok=True)
+    results_filename = os.path.join(
+        args.results_directory, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    with open(results_filename, "w") as f:
+        json.dump({"configuration": configuration, "results": results}, f, indent=2)
+    print(f"=== SAVED THE RESULTS TO {results_filename} ===")
+
+    if args.fail_on_regression and regressed:
+        sys.exit(1)
@@ -0,0 +1,136 @@
+import os
+import yaml
+from shlex import quote
+from argparse import ArgumentParser
+from beartype import beartype
+
+import pod_manifest
+from pod_manifest import PodTemplateParameters
+from setup import run_command
+
+
+SANDBOX_DIRECTORY: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox")
+BASE_DOCKERFILE: str = os.path.join(SANDBOX_DIRECTORY, "Dockerfile")
+SSH_DOCKERFILE: str = os.path.join(SANDBOX_DIRECTORY, "Dockerfile.ssh")
+
+DEFAULT_BASE_IMAGE: str = "volodimir1024/reward-hacking-cuda-128:v1.0"
+# not the image of ssh_pod_template.yaml, pods only use it with --pod-image once it is pushed
+DEFAULT_IMAGE: str = "volodimir1024/reward-hacking-cuda-128-ssh:v1.0"
+
+
+@beartype
+def get_build_commands(
+    image: str = DEFAULT_IMAGE,
+    base_image: str = DEFAULT_BASE_IMAGE,
+    build_base_image: bool = True,
+    rl_github_repo: str | None = None,
+    rl_github_branch: str | None = None,
+    github_token_filename: str | None = None,
+    push: bool = True,
+) -> list[list[str]]:
+    """
+    Builds sandbox/Dockerfile as `base_image`, then sandbox/Dockerfile.ssh on top of it as `image`.
+    With `rl_github_repo`, the image also has the dependencies of the RL repo in uv's cache.
+    The github token is passed as a build secret, so that it does not end up in the image.
+    """
+
+    commands: list[list[str]] = []
+    if build_base_image:
+        commands.append(
+            ["docker", "build", "-f", BASE_DOCKERFILE, "-t", base_image, SANDBOX_DIRECTORY]
+        )
+
+    ssh_image_command = [
+        "docker",
+        "build",
+        "-f",
+        SSH_DOCKERFILE,
+        "--build-arg",
+        f"BASE_IMAGE={base_image}",
+    ]
+    if rl_github_repo is not None:
+        ssh_image_command += ["--build-arg", f"RL_GITHUB_REPO={rl_github_repo}"]
+    if rl_github_branch is not None:
+        ssh_image_command += ["--build-arg", f"RL_GITHUB_BRANCH={rl_github_branch}"]
+    if github_token_filename is not None:
+        ssh_image_command += ["--secret", f"id=github_token,src={github_token_filename}"]
+    ssh_image_command += ["-t", image, SANDBOX_DIRECTORY]
+    commands.append(ssh_image_command)
+
+    if push:
+        if build_base_image:
+            commands.append(["docker", "push", base_image])
+        commands.append(["docker", "push", image])
+    return commands
+
+
+@beartype
+def render_dry_run(commands: list[list[str]], image: str) -> str:
+    """
+    The build commands and the manifest of a pod using the image, without running anything.
+    """
+
+    for dockerfile in [BASE_DOCKERFILE, SSH_DOCKERFILE]:
+        assert os.path.exists(dockerfile), f"{dockerfile} does not exist."
+
+    pod_objects = pod_manifest.render_pod_manifests(
+        1, name_prefix="ssh-pod-dry-run", parameters=PodTemplateParameters(image=image, image_has_sshd=True)
+    )
+    container = pod_manifest.get_pod_container(pod_objects[0])
+    assert "apt-get" not in " ".join(container.get("command", [])), (
+        "The pod template still installs sshd when the pod starts."
+    )
+
+    lines: list[str] = ["=== BUILD COMMANDS ==="]
+    lines += [" ".join(quote(field) for field in command) for command in commands]
+    lines.append("=== POD MANIFEST ===")
+    lines.append(yaml.safe_dump_all(pod_objects, sort_keys=False))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Build and push the pod image, which has sshd preconfigured so that pods start it immediately."
+    )
+    parser.add_argument("--image", type=str, default=DEFAULT_IMAGE)
+    parser.add_argument("--base-image", type=str, default=DEFAULT_BASE_IMAGE, help="The image of sandbox/Dockerfile.")
+    parser.add_argument(
+        "--skip-base-image",
+        action="store_true",
+        help="Use the existing --base-image instead of building sandbox/Dockerfile.",
+    )
+    parser.add_argument(
+        "--rl-github-repo",
+        type=str,
+        help="Pre-sync the dependencies of this repo (e.g. JYudelson1/swe-tests) in the image, so that uv sync on the pods is faster.",
+    )
+    parser.add_argument("--rl-github-branch", type=str)
+    parser.add_argument(
+        "--github-token-filename",
+        type=str,
+        help="File containing a github token, if --rl-github-repo is private.",
+    )
+    parser.add_argument("--no-push", action="store_true")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print the build commands and the pod manifest using the image.",
+    )
+    args = parser.parse_args()
+
+    commands = get_build_commands(
+        image=args.image,
+        base_image=args.base_image,
+        build_base_image=not args.skip_base_image,
+        rl_github_repo=args.rl_github_repo,
+        rl_github_branch=args.rl_github_branch,
+        github_token_filename=args.github_token_filename,
+        push=not args.no_push,
+    )
+
+    if args.dry_run:
+        print(render_dry_run(commands, image=args.image))
+    else:
+        for command in commands:
+            run_command(command, truncate_output_to_length=4096)
+        print(f"=== BUILT {args.image}, PASS --pod-image {args.image} --pod-image-has-sshd TO setup.py ===")
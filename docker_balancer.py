@@ -0,0 +1,156 @@
+"""
+Spreads docker operations across the remote docker hosts which setup.py registered as docker contexts on the pods.
+setup.py copies this file to ~/.sfcompute/python/ on every pod, together with the list of contexts.
+
+Each context has as many slots as the docker host accepts ssh sessions per connection, and every operation holds
+one slot while it runs. A slot is a file locked with flock, so the slots are shared by all the processes on a pod
+and are freed when a process dies. New containers go to the context with the fewest busy slots, and operations on
+an existing container must stay on the context it was created on.
+
+From python:
+    balancer = DockerBalancer()
+    with balancer.slot() as context:
+        subprocess.run(["docker", "--context", context, "run", ...])
+    with balancer.slot(context):
+        subprocess.run(["docker", "--context", context, "exec", ...])
+
+From the shell, the command runs with DOCKER_CONTEXT set to the chosen context, which is printed to stderr:
+    python3 ~/.sfcompute/python/docker_balancer.py run -- docker run ...
+    python3 ~/.sfcompute/python/docker_balancer.py run --context <context> -- docker exec ...
+    python3 ~/.sfcompute/python/docker_balancer.py status
+
+Only the standard library is used, since this runs with the pods' system python.
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+import subprocess
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+
+CONFIG_FILENAME = os.path.expanduser("~/.sfcompute/docker_hosts.json")
+SLOTS_DIRECTORY = os.path.expanduser("~/.sfcompute/docker_slots")
+POLL_INTERVAL_SECONDS = 0.05
+
+
+@dataclass(frozen=True)
+class DockerHost:
+    context: str
+    # e.g. ssh://user@1.2.3.4, which docker-py's DockerClient accepts as base_url
+    url: str
+    # how many operations may run on the host at the same time
+    slots: int
+
+
+def load_hosts(config_filename=CONFIG_FILENAME):
+    with open(config_filename) as f:
+        return [DockerHost(**host) for host in json.load(f)["hosts"]]
+
+
+def choose_context(busy_slots, hosts):
+    """
+    The context with the most free slots relative to its number of slots, None if all of them are full.
+    Ties are broken at random, so that processes choosing at the same time spread out.
+    """
+
+    candidates = [host for host in hosts if busy_slots[host.context] < host.slots]
+    if len(candidates) == 0:
+        return None
+    return min(
+        candidates,
+        key=lambda host: (busy_slots[host.context] / host.slots, random.random()),
+    ).context
+
+
+class DockerBalancer:
+    def __init__(self, hosts=None, slots_directory=SLOTS_DIRECTORY):
+        self.hosts = hosts if hosts is not None else load_hosts()
+        assert len(self.hosts) > 0, "No docker hosts are configured."
+        self.hosts_by_context = {host.context: host for host in self.hosts}
+        self.slots_directory = slots_directory
+        os.makedirs(slots_directory, exist_ok=True)
+
+    def get_url(self, context):
+        return self.hosts_by_context[context].url
+
+    def slot_filename(self, context, i_slot):
+        return os.path.join(self.slots_directory, f"{context}.{i_slot}")
+
+    def try_lock_slot(self, context):
+        """
+        An open file holding the lock of a free slot of the context, None if all its slots are busy.
+        """
+
+        for i_slot in random.sample(range(self.hosts_by_context[context].slots), self.hosts_by_context[context].slots):
+            f = open(self.slot_filename(context, i_slot), "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return f
+            except BlockingIOError:
+                f.close()
+        return None
+
+    def count_busy_slots(self, context):
+        busy = 0
+        for i_slot in range(self.hosts_by_context[context].slots):
+            with open(self.slot_filename(context, i_slot), "a") as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    busy += 1
+        return busy
+
+    def busy_slots(self):
+        return {host.context: self.count_busy_slots(host.context) for host in self.hosts}
+
+    @contextmanager
+    def slot(self, context=None, timeout_seconds=None):
+        """
+        Yields the context to run a docker operation on and holds one of its slots until the block exits.
+        Without `context`, the least loaded one is chosen. Waits while the slots are all busy.
+        """
+
+        assert context is None or context in self.hosts_by_context, f"Unknown docker context {context!r}."
+        deadline = time.monotonic() + timeout_seconds if timeout_seconds is not None else None
+        while True:
+            if context is not None:
+                chosen_context = context
+            else:
+                chosen_context = choose_context(self.busy_slots(), self.hosts)
+            lock_file = self.try_lock_slot(chosen_context) if chosen_context is not None else None
+            if lock_file is not None:
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"All the slots of the docker contexts were busy for {timeout_seconds} seconds.")
+            time.sleep(POLL_INTERVAL_SECONDS)
+        try:
+            yield chosen_context
+        finally:
+            lock_file.close()
+
+
+def main(arguments):
+    balancer = DockerBalancer()
+    if arguments[:1] == ["status"]:
+        busy_slots = balancer.busy_slots()
+        for host in balancer.hosts:
+            print(f"{host.context:<32} {host.url:<40} {busy_slots[host.context]}/{host.slots} BUSY")
+        return 0
+
+    assert arguments[:1] == ["run"] and "--" in arguments, (
+        "Usage: docker_balancer.py status | run [--context <context>] -- <command>..."
+    )
+    options, command = arguments[1 : arguments.index("--")], arguments[arguments.index("--") + 1 :]
+    context = options[options.index("--context") + 1] if "--context" in options else None
+    with balancer.slot(context) as chosen_context:
+        print(f"DOCKER CONTEXT: {chosen_context}", file=sys.stderr, flush=True)
+        return subprocess.run(command, env={**os.environ, "DOCKER_CONTEXT": chosen_context}).returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,66 @@
+import os
+from argparse import ArgumentParser
+from beartype import beartype
+
+import setup
+import pod_manifest
+import port_forward
+
+
+@beartype
+def down(
+    kubernetes_config_filename: str = pod_manifest.RENDERED_MANIFEST_FILENAME,
+    wait: bool = True,
+    max_concurrency: int = setup.DEFAULT_MAX_CONCURRENCY,
+    kubernetes_backend_name: str = "api",
+) -> None:
+    """
+    Stops ray on all pods at the same time (so that the jobs on it are told to stop instead of being killed with
+    their pod), stops the port forwards, then deletes all the pods.
+    """
+
+    if os.path.exists(port_forward.SUPERVISOR_STATE_FILENAME):
+        try:
+            pods = setup.get_pods_from_port_forwards()
+        except AssertionError as e:
+            print(f"=== NOT STOPPING RAY: {e} ===")
+        else:
+            print(f"=== STOPPING RAY ON {len(pods)} PODS ===")
+            setup.stop_ray(pods, max_concurrency=max_concurrency)
+        port_forward.stop_port_forward_supervisor()
+
+    assert os.path.exists(kubernetes_config_filename), (
+        f"{kubernetes_config_filename} does not exist, pass the manifest the pods were created from."
+    )
+    # everything the manifest created is deleted, not only its pods
+    objects = pod_manifest.load_kubernetes_objects(kubernetes_config_filename)
+    setup.choose_kubernetes_backend(kubernetes_backend_name, objects)
+    setup.delete_pod_objects(objects, wait=wait)
+    print("=== ALL PODS ARE DELETED ===" if wait else "=== ALL PODS ARE BEING DELETED ===")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Tear down the cluster set up by setup.py: stop ray, stop the port forwards and delete the pods."
+    )
+    parser.add_argument(
+        "--kubernetes-config-filename",
+        type=str,
+        default=pod_manifest.RENDERED_MANIFEST_FILENAME,
+        help="The manifest the pods were created from, if it was passed to setup.py.",
+    )
+    parser.add_argument(
+        "--no-wait",
+        action="store_true",
+        help="Return as soon as the pods are marked for deletion, without waiting until they are gone.",
+    )
+    parser.add_argument("--max-concurrency", type=int, default=setup.DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--kubernetes-backend", choices=setup.KUBERNETES_BACKENDS, default="api")
+    args = parser.parse_args()
+
+    down(
+        kubernetes_config_filename=args.kubernetes_config_filename,
+        wait=not args.no_wait,
+        max_concurrency=args.max_concurrency,
+        kubernetes_backend_name=args.kubernetes_backend,
+    )
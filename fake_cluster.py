@@ -0,0 +1,536 @@
+"""
+Simulated `sf`, `kubectl`, `ssh` and the tools setup.py runs on the pods, so that setup.py can be benchmarked without a cluster.
+`install_fake_executables` writes shims which run this file, and `benchmark.py` puts them first on PATH.
+fake_kubernetes_api.py serves a stub of the kubernetes api server, which shares its pods with the fake kubectl.
+
+Each simulated pod is a directory under the state directory, keyed by its name.
+The fake ssh and kubectl exec run commands for real with bash in that directory, after rewriting the absolute paths
+which must be per pod. The fake ssh finds the pod from the port, which the fake port forward to the pod records.
+The network test runs for real, with the pods reaching each other on localhost.
+The behavior is configured with the FAKE_* environment variables below.
+Nothing here is type checked with beartype: this file runs once per simulated command, and importing beartype would dominate its cost.
+"""
+
+import os
+import re
+import sys
+import json
+import zlib
+import random
+import socket
+import subprocess
+from time import sleep, time
+
+
+STATE_DIRECTORY_VARIABLE: str = "FAKE_CLUSTER_DIRECTORY"
+BIN_DIRECTORY_VARIABLE: str = "FAKE_CLUSTER_BIN_DIRECTORY"
+
+# every call to ssh, kubectl and sf sleeps this long first
+LATENCY_SECONDS_VARIABLE: str = "FAKE_LATENCY_SECONDS"
+# probability that an ssh command fails as if the connection dropped
+FAILURE_RATE_VARIABLE: str = "FAKE_FAILURE_RATE"
+# how much output `uv sync` prints
+OUTPUT_BYTES_VARIABLE: str = "FAKE_OUTPUT_BYTES"
+UV_SYNC_SECONDS_VARIABLE: str = "FAKE_UV_SYNC_SECONDS"
+# size of the files `uv sync` puts in the virtual environment
+VENV_MEGABYTES_VARIABLE: str = "FAKE_VENV_MEGABYTES"
+POD_START_SECONDS_VARIABLE: str = "FAKE_POD_START_SECONDS"
+SSHD_START_SECONDS_VARIABLE: str = "FAKE_SSHD_START_SECONDS"
+RAY_START_SECONDS_VARIABLE: str = "FAKE_RAY_START_SECONDS"
+GPUS_PER_POD_VARIABLE: str = "FAKE_GPUS_PER_POD"
+# every request to the stub kubernetes api server sleeps this long first, a round trip over an open connection
+API_LATENCY_SECONDS_VARIABLE: str = "FAKE_API_LATENCY_SECONDS"
+# the namespace of the kubectl context, and of the kubeconfig of the stub api server
+DEFAULT_NAMESPACE: str = "default"
+
+DEFAULT_CONFIGURATION: dict[str, str] = {
+    LATENCY_SECONDS_VARIABLE: "0.05",
+    FAILURE_RATE_VARIABLE: "0.0",
+    OUTPUT_BYTES_VARIABLE: "100000",
+    UV_SYNC_SECONDS_VARIABLE: "1.0",
+    VENV_MEGABYTES_VARIABLE: "1",
+    POD_START_SECONDS_VARIABLE: "2.0",
+    SSHD_START_SECONDS_VARIABLE: "1.0",
+    RAY_START_SECONDS_VARIABLE: "0.5",
+    GPUS_PER_POD_VARIABLE: "8",
+    API_LATENCY_SECONDS_VARIABLE: "0.005",
+}
+
+FAKE_EXECUTABLES: list[str] = ["sf", "kubectl", "ssh", "ssh-keygen", "hostname", "uv", "nvidia-smi", "all_reduce_perf"]
+# the script of network_test.py, which is not imported to keep each simulated command cheap
+NETWORK_TEST_SCRIPT_NAME: str = "sfcompute_network_test.py"
+SPAWN_LOG_FILENAME: str = "spawns.log"
+
+
+def get_configuration(name: str) -> float:
+    return float(os.environ.get(name, DEFAULT_CONFIGURATION[name]))
+
+
+def get_state_directory() -> str:
+    return os.environ[STATE_DIRECTORY_VARIABLE]
+
+
+def get_pod_home(name: str) -> str:
+    return os.path.join(get_state_directory(), "pods", name)
+
+
+def get_pod_ip(name: str) -> str:
+    number = zlib.crc32(name.encode())
+    return f"10.{(number >> 16) & 255}.{(number >> 8) & 255}.{number & 255}"
+
+
+def get_port_forward_filename(port: int) -> str:
+    return os.path.join(get_state_directory(), "port_forwards", str(port))
+
+
+def log_spawn(tool: str) -> None:
+    with open(os.path.join(get_state_directory(), SPAWN_LOG_FILENAME), "a") as f:
+        f.write(tool + "\n")
+
+
+def count_spawns(state_directory: str) -> dict[str, int]:
+    filename = os.path.join(state_directory, SPAWN_LOG_FILENAME)
+    if not os.path.exists(filename):
+        return {}
+    counts: dict[str, int] = {}
+    with open(filename) as f:
+        for line in f:
+            counts[line.strip()] = counts.get(line.strip(), 0) + 1
+    return counts
+
+
+def install_fake_executables(state_directory: str) -> str:
+    """
+    Writes one shim per fake executable and returns the directory to put first on PATH.
+    """
+
+    bin_directory = os.path.join(state_directory, "bin")
+    os.makedirs(bin_directory, exist_ok=True)
+    for tool in FAKE_EXECUTABLES + ["ray"]:
+        filename = os.path.join(bin_directory, tool)
+        with open(filename, "w") as f:
+            f.write(
+                f'#!/bin/sh\nexec {sys.executable} {os.path.abspath(__file__)} {tool} "$@"\n'
+            )
+        os.chmod(filename, 0o755)
+
+    # `import ray` in the virtual environment's python gets the fake ray module
+    python_directory = os.path.join(state_directory, "python")
+    os.makedirs(python_directory, exist_ok=True)
+    with open(os.path.join(python_directory, "ray.py"), "w") as f:
+        f.write("from fake_cluster import ray_init as init, ray_nodes as nodes\n")
+
+    return bin_directory
+
+
+def rewrite_remote_command(command: str, pod_home: str) -> str:
+    """
+    Every pod has its own /tmp and /data, and uv is called by its absolute path.
+    """
+
+    command = re.sub(r"(?<![\w./-])/(tmp|data)/", f"{pod_home}/\\1/", command)
+    # the same for the absolute paths of the archives setup.py's push_files extracts
+    command = re.sub(
+        r"tar -x\w*Pf -",
+        lambda match: match.group(0) + f" --transform 's,^/\\(tmp\\|data\\)/,{pod_home}/\\1/,'",
+        command,
+    )
+    # the pods' addresses are not routable, and the one network test server which binds the port serves all the pods
+    if NETWORK_TEST_SCRIPT_NAME in command:
+        command = re.sub(r"\b10\.\d+\.\d+\.\d+\b", "127.0.0.1", command)
+    return command.replace(
+        "/root/.local/bin/", os.environ[BIN_DIRECTORY_VARIABLE] + "/"
+    )
+
+
+def get_pods_filename() -> str:
+    return os.path.join(get_state_directory(), "kubernetes_pods.json")
+
+
+def load_pods() -> dict:
+    """
+    The applied pods, as
+    {"names": [...], "namespaces": {name: namespace}, "objects": {name: object}, "apply_time": seconds since the epoch}.
+    """
+
+    if not os.path.exists(get_pods_filename()):
+        return {"names": [], "namespaces": {}, "objects": {}, "apply_time": time()}
+    with open(get_pods_filename()) as f:
+        return {"namespaces": {}, "objects": {}, **json.load(f)}
+
+
+def get_watched_pod_names(pods: dict, namespace: str) -> list[str]:
+    """
+    Like the real cluster, a watch of a namespace only sees the pods in that namespace.
+    """
+
+    return [name for name in pods["names"] if pods["namespaces"].get(name, DEFAULT_NAMESPACE) == namespace]
+
+
+def save_pods(pods: dict) -> None:
+    # the port forwards read the file concurrently
+    with open(get_pods_filename() + ".tmp", "w") as f:
+        json.dump(pods, f)
+    os.replace(get_pods_filename() + ".tmp", get_pods_filename())
+
+
+def get_pod_timeline() -> list[tuple[float, str, str | None, bool]]:
+    """
+    (seconds after the apply, phase, waiting reason, ready) of the statuses every pod goes through.
+    """
+
+    start_seconds = get_configuration(POD_START_SECONDS_VARIABLE)
+    # the readiness probe on sshd succeeds once sshd started
+    return [
+        (0.0, "Pending", None, False),
+        (start_seconds / 2, "Pending", "ContainerCreating", False),
+        (start_seconds, "Running", None, False),
+        (start_seconds + get_configuration(SSHD_START_SECONDS_VARIABLE), "Running", None, True),
+    ]
+
+
+def fake_sf(arguments: list[str]) -> int:
+    sleep(get_configuration(LATENCY_SECONDS_VARIABLE))
+    if arguments[:2] == ["clusters", "list"]:
+        print("Name fake-cluster")
+    return 0
+
+
+def make_pod_object(name: str, phase: str, waiting_reason: str | None, ready: bool) -> dict:
+    container_state: dict = (
+        {"waiting": {"reason": waiting_reason}}
+        if waiting_reason is not None
+        else {"running": {}}
+    )
+    return {
+        "kind": "Pod",
+        "metadata": {"name": name},
+        "status": {
+            "phase": phase,
+            "conditions": [{"type": "Ready", "status": "True" if ready else "False"}],
+            "containerStatuses": [{"name": "cuda", "state": container_state, "ready": ready}],
+        },
+    }
+
+
+def fake_kubectl(arguments: list[str]) -> int:
+    if arguments[0] == "port-forward":
+        namespace = arguments[arguments.index("--namespace") + 1] if "--namespace" in arguments else DEFAULT_NAMESPACE
+        return fake_port_forward(arguments[1].removeprefix("pod/"), arguments[2], namespace)
+
+    sleep(get_configuration(LATENCY_SECONDS_VARIABLE))
+
+    if arguments[0] == "apply":
+        import yaml
+
+        with open(arguments[arguments.index("-f") + 1]) as f:
+            documents = [d for d in yaml.safe_load_all(f) if d is not None]
+        names = [d["metadata"]["name"] for d in documents]
+        namespaces = {d["metadata"]["name"]: d["metadata"].get("namespace", DEFAULT_NAMESPACE) for d in documents}
+        save_pods({"names": names, "namespaces": namespaces, "objects": {}, "apply_time": time()})
+        for name in names:
+            print(f"pod/{name} created")
+        return 0
+
+    if arguments[:2] == ["get", "pods"] and "--watch" in arguments:
+        pods = load_pods()
+        namespace = arguments[arguments.index("--namespace") + 1] if "--namespace" in arguments else DEFAULT_NAMESPACE
+        for offset, phase, waiting_reason, ready in get_pod_timeline():
+            sleep(max(0.0, pods["apply_time"] + offset - time()))
+            for name in get_watched_pod_names(pods, namespace):
+                print(json.dumps(make_pod_object(name, phase, waiting_reason, ready), indent=4), flush=True)
+        # like the real kubectl, keeps watching until it is killed
+        while True:
+            sleep(3600)
+
+    if arguments[0] == "exec":
+        return fake_kubectl_exec(arguments)
+
+    print(f"fake kubectl does not support {arguments}", file=sys.stderr)
+    return 1
+
+
+def fake_kubectl_exec(arguments: list[str]) -> int:
+    """
+    kubectl exec -i [--namespace <namespace>] <pod> -- bash -c <command>
+    """
+
+    options = arguments[1 : arguments.index("--")]
+    if "--namespace" in options:
+        del options[options.index("--namespace") : options.index("--namespace") + 2]
+    name = [option for option in options if option != "-i"][0]
+    if random.random() < get_configuration(FAILURE_RATE_VARIABLE):
+        print("error: unable to upgrade connection: connection reset by peer", file=sys.stderr)
+        return 1
+    pods = load_pods()
+    if name not in pods["names"]:
+        print(f'Error from server (NotFound): pods "{name}" not found', file=sys.stderr)
+        return 1
+    if time() < pods["apply_time"] + get_configuration(POD_START_SECONDS_VARIABLE):
+        print("error: unable to upgrade connection: container not found (\"cuda\")", file=sys.stderr)
+        return 1
+    return run_in_pod(name, arguments[-1])
+
+
+def fake_port_forward(pod_name: str, ports: str, namespace: str) -> int:
+    """
+    Accepts connections on the host port, and closes them until sshd would have started in the pod.
+    Fails like kubectl if the pod is not in `namespace`.
+    """
+
+    pods = load_pods()
+    if pod_name in pods["names"] and pod_name not in get_watched_pod_names(pods, namespace):
+        print(f'Error from server (NotFound): pods "{pod_name}" not found', file=sys.stderr)
+        return 1
+
+    host_port = int(ports.split(":")[0])
+    os.makedirs(os.path.dirname(get_port_forward_filename(host_port)), exist_ok=True)
+    with open(get_port_forward_filename(host_port), "w") as f:
+        f.write(pod_name)
+    apply_time = pods["apply_time"]
+    sshd_start_time = (
+        apply_time
+        + get_configuration(POD_START_SECONDS_VARIABLE)
+        + get_configuration(SSHD_START_SECONDS_VARIABLE)
+    )
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", host_port))
+    server.listen(128)
+    print(f"Forwarding from 127.0.0.1:{host_port} -> 22", flush=True)
+    while True:
+        connection, _ = server.accept()
+        if time() >= sshd_start_time:
+            connection.sendall(b"SSH-2.0-OpenSSH_fake\r\n")
+        connection.close()
+
+
+def fake_ssh(arguments: list[str]) -> int:
+    port = int(arguments[arguments.index("-p") + 1]) if "-p" in arguments else 22
+    # control connections: opening a master (-N) or sending it a command (-O)
+    if "-N" in arguments or "-O" in arguments:
+        return 0
+
+    sleep(get_configuration(LATENCY_SECONDS_VARIABLE))
+    if random.random() < get_configuration(FAILURE_RATE_VARIABLE):
+        print("kex_exchange_identification: Connection reset by peer", file=sys.stderr)
+        return 255
+
+    if not os.path.exists(get_port_forward_filename(port)):
+        print(f"ssh: connect to host localhost port {port}: Connection refused", file=sys.stderr)
+        return 255
+    with open(get_port_forward_filename(port)) as f:
+        return run_in_pod(f.read(), arguments[-1])
+
+
+def run_in_pod(name: str, command: str) -> int:
+    pod_home = get_pod_home(name)
+    os.makedirs(os.path.join(pod_home, "tmp"), exist_ok=True)
+    environment = {
+        **os.environ,
+        "HOME": pod_home,
+        "PATH": os.environ[BIN_DIRECTORY_VARIABLE] + ":" + os.environ["PATH"],
+        "FAKE_POD_IP": get_pod_ip(name),
+    }
+    command = rewrite_remote_command(command, pod_home)
+
+    # scripts come over stdin, anything else on stdin (e.g. archives) is passed through untouched
+    input: bytes | None = None
+    if "bash -s" in command:
+        input = rewrite_remote_command(sys.stdin.read(), pod_home).encode()
+    return subprocess.run(
+        ["bash", "-c", command],
+        cwd=pod_home,
+        env=environment,
+        input=input,
+        stdin=None if input is not None else sys.stdin,
+    ).returncode
+
+
+def fake_hostname(arguments: list[str]) -> int:
+    print(os.environ.get("FAKE_POD_IP", "127.0.0.1"))
+    return 0
+
+
+# in the format of `nvidia-smi --query-gpu=index,utilization.gpu,memory.used,memory.total,temperature.gpu,power.draw --format=csv,noheader,nounits`
+# on an 8xH100 node with an idle gpu, and values some gpus do not report
+NVIDIA_SMI_OUTPUT: str = """0, 97, 71234, 81559, 64, 612.48
+1, 95, 70988, 81559, 61, 598.02
+2, 0, 4, 81559, [Not Supported], 71.20
+3, 96, 71102, 81559, 63, 605.77
+4, 94, 70876, 81559, 60, 590.13
+5, 97, 71301, 81559, 66, 620.91
+6, 93, 70755, 81559, 59, [N/A]
+7, 96, 71190, 81559, 62, 601.36
+"""
+
+
+# in the format of `df -B1 --output=target,size,used /dev/shm /data` on a pod of ssh_pod_template.yaml
+DF_OUTPUT: str = """Mounted on         1B-blocks          Used
+/dev/shm         68719476736   12884901888
+/data          3936818520064  412316860416
+"""
+
+
+def fake_nvidia_smi(arguments: list[str]) -> int:
+    """
+    The first FAKE_GPUS_PER_POD lines of the captured output, whatever the query.
+    """
+
+    lines = NVIDIA_SMI_OUTPUT.splitlines()
+    print("\n".join(lines[: int(get_configuration(GPUS_PER_POD_VARIABLE))]))
+    return 0
+
+
+# in the format nccl-tests' all_reduce_perf prints on an 8xH100 node, ending with the average of the busbw column
+ALL_REDUCE_PERF_OUTPUT: str = """# nThread 1 nGpus 8 minBytes 8388608 maxBytes 268435456 step: 2(factor) warmup iters: 5 iters: 20 agg iters: 1 validation: 1 graph: 0
+#
+# Using devices
+#  Rank  0 Group  0 Pid   4113 on  ssh-pod-0 device  0 [0x18] NVIDIA H100 80GB HBM3
+#  Rank  1 Group  0 Pid   4113 on  ssh-pod-0 device  1 [0x2a] NVIDIA H100 80GB HBM3
+#  Rank  2 Group  0 Pid   4113 on  ssh-pod-0 device  2 [0x3a] NVIDIA H100 80GB HBM3
+#  Rank  3 Group  0 Pid   4113 on  ssh-pod-0 device  3 [0x5d] NVIDIA H100 80GB HBM3
+#  Rank  4 Group  0 Pid   4113 on  ssh-pod-0 device  4 [0x9a] NVIDIA H100 80GB HBM3
+#  Rank  5 Group  0 Pid   4113 on  ssh-pod-0 device  5 [0xab] NVIDIA H100 80GB HBM3
+#  Rank  6 Group  0 Pid   4113 on  ssh-pod-0 device  6 [0xba] NVIDIA H100 80GB HBM3
+#  Rank  7 Group  0 Pid   4113 on  ssh-pod-0 device  7 [0xdb] NVIDIA H100 80GB HBM3
+#
+#                                                              out-of-place                       in-place          
+#       size         count      type   redop    root     time   algbw   busbw #wrong     time   algbw   busbw #wrong
+#        (B)    (elements)                               (us)  (GB/s)  (GB/s)            (us)  (GB/s)  (GB/s)       
+     8388608       2097152     float     sum      -1    79.52  105.49  184.61      0    78.90  106.32  186.06      0
+    16777216       4194304     float     sum      -1   118.40  141.70  247.97      0   117.90  142.30  249.03      0
+    33554432       8388608     float     sum      -1   192.60  174.22  304.88      0   191.80  174.94  306.15      0
+    67108864      16777216     float     sum      -1   341.70  196.40  343.69      0   340.90  196.86  344.50      0
+   134217728      33554432     float     sum      -1   630.20  212.98  372.71      0   629.50  213.21  373.12      0
+   268435456      67108864     float     sum      -1  1207.30  222.34  389.10      0  1206.10  222.56  389.49      0
+# Out of bounds values : 0 OK
+# Avg bus bandwidth    : 307.61 
+#
+"""
+ALL_REDUCE_PERF_BUS_BANDWIDTH: float = 307.61
+
+
+def fake_all_reduce_perf(arguments: list[str]) -> int:
+    print(ALL_REDUCE_PERF_OUTPUT, end="")
+    return 0
+
+
+def fake_uv(arguments: list[str]) -> int:
+    if arguments[0] == "venv":
+        os.makedirs(".venv/bin", exist_ok=True)
+        with open(".venv/pyvenv.cfg", "w") as f:
+            f.write(f"home = {os.path.dirname(sys.executable)}\n")
+        return 0
+
+    if arguments[0] == "sync":
+        sleep(get_configuration(UV_SYNC_SECONDS_VARIABLE))
+        output_bytes = int(get_configuration(OUTPUT_BYTES_VARIABLE))
+        line_number = 0
+        while output_bytes > 0:
+            line = f" + fake-package-{line_number}==1.0.0\n"
+            sys.stdout.write(line)
+            output_bytes -= len(line)
+            line_number += 1
+
+        state_directory = get_state_directory()
+        with open(".venv/bin/python", "w") as f:
+            f.write(
+                f'#!/bin/sh\nPYTHONPATH={state_directory}/python:{os.path.dirname(os.path.abspath(__file__))} exec {sys.executable} "$@"\n'
+            )
+        os.chmod(".venv/bin/python", 0o755)
+        with open(".venv/bin/ray", "w") as f:
+            f.write(f'#!/bin/sh\nexec {os.environ[BIN_DIRECTORY_VARIABLE]}/ray "$@"\n')
+        os.chmod(".venv/bin/ray", 0o755)
+        with open(".venv/packages.bin", "wb") as f:
+            f.write(random.randbytes(int(get_configuration(VENV_MEGABYTES_VARIABLE) * 1e6)))
+        return 0
+
+    print(f"fake uv does not support {arguments}", file=sys.stderr)
+    return 1
+
+
+def get_ray_node_filename(ip: str) -> str:
+    return os.path.join(get_state_directory(), "ray_nodes", f"{ip}.json")
+
+
+def fake_ray(arguments: list[str]) -> int:
+    ip = os.environ["FAKE_POD_IP"]
+
+    if arguments[0] == "stop":
+        if os.path.exists(get_ray_node_filename(ip)):
+            os.remove(get_ray_node_filename(ip))
+        print("Stopped all Ray processes.")
+        return 0
+
+    if arguments[0] == "start":
+        sleep(get_configuration(RAY_START_SECONDS_VARIABLE))
+        os.makedirs(os.path.dirname(get_ray_node_filename(ip)), exist_ok=True)
+        with open(get_ray_node_filename(ip), "w") as f:
+            options = dict(argument.removeprefix("--").split("=", 1) for argument in arguments if "=" in argument)
+            json.dump(
+                {
+                    "ip": ip,
+                    "gpus": float(options.get("num-gpus", get_configuration(GPUS_PER_POD_VARIABLE))),
+                    "cpus": float(options.get("num-cpus", 1.0)),
+                },
+                f,
+            )
+        if "--head" in arguments:
+            ray_directory = os.path.join(os.environ["HOME"], "tmp", "ray")
+            session_directory = os.path.join(ray_directory, f"session_{time():.6f}")
+            os.makedirs(session_directory)
+            with open(os.path.join(ray_directory, "ray_current_cluster"), "w") as f:
+                f.write(f"{ip}:6379\n")
+            if os.path.lexists(os.path.join(ray_directory, "session_latest")):
+                os.remove(os.path.join(ray_directory, "session_latest"))
+            os.symlink(session_directory, os.path.join(ray_directory, "session_latest"))
+            print(f"  ray start --address='{ip}:6379'")
+        print("Ray runtime started.")
+        return 0
+
+    if arguments[0] == "status":
+        nodes = ray_nodes()
+        print(f"{len(nodes)} nodes")
+        print(f" 0.0/{sum(node['Resources']['GPU'] for node in nodes)} GPU")
+        return 0
+
+    print(f"fake ray does not support {arguments}", file=sys.stderr)
+    return 1
+
+
+def ray_init(**kwargs) -> None:
+    pass
+
+
+def ray_nodes() -> list[dict]:
+    directory = os.path.join(get_state_directory(), "ray_nodes")
+    nodes: list[dict] = []
+    for filename in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        with open(os.path.join(directory, filename)) as f:
+            node = json.load(f)
+        nodes.append(
+            {
+                "NodeManagerAddress": node["ip"],
+                "Alive": True,
+                "Resources": {"GPU": node["gpus"], "CPU": node["cpus"]},
+            }
+        )
+    return nodes
+
+
+if __name__ == "__main__":
+    tool, arguments = sys.argv[1], sys.argv[2:]
+    log_spawn(tool)
+    fake_tools = {
+        "sf": fake_sf,
+        "kubectl": fake_kubectl,
+        "ssh": fake_ssh,
+        "ssh-keygen": lambda arguments: 0,
+        "hostname": fake_hostname,
+        "uv": fake_uv,
+        "ray": fake_ray,
+        "nvidia-smi": fake_nvidia_smi,
+        "all_reduce_perf": fake_all_reduce_perf,
+    }
+    sys.exit(fake_tools[tool](arguments))
@@ -0,0 +1,173 @@
+"""
+A stub of the kubernetes api server, for benchmarking setup.py's api backend without a cluster.
+The pods it serves are the ones of fake_cluster.py, so that the fake port forwards and ssh work with either backend.
+It runs in background threads of the benchmark process, instead of once per command like fake_cluster.py.
+"""
+
+import os
+import json
+import threading
+from time import sleep, time
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fake_cluster import (
+    API_LATENCY_SECONDS_VARIABLE,
+    DEFAULT_NAMESPACE,
+    get_configuration,
+    get_pod_timeline,
+    get_watched_pod_names,
+    load_pods,
+    make_pod_object,
+    save_pods,
+)
+
+
+class FakeKubernetesApiHandler(BaseHTTPRequestHandler):
+    """
+    The requests setup.py's api backend sends: server-side applies, gets and deletes of pods, and a list and a watch
+    of all pods. The resourceVersion of a list is how many statuses of the pod timeline the pods went through, and a
+    watch from it only sends the next ones.
+    """
+
+    protocol_version = "HTTP/1.1"
+    lock = threading.Lock()
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_json(self, status: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_path_parts(self) -> list[str]:
+        # /api/v1/namespaces/<namespace>/pods[/<name>]
+        return urlparse(self.path).path.strip("/").split("/")
+
+    def get_namespace(self) -> str:
+        return self.get_path_parts()[3]
+
+    def get_pod_name(self) -> str | None:
+        parts = self.get_path_parts()
+        return parts[5] if len(parts) == 6 and parts[4] == "pods" else None
+
+    def get_pod_object(self, pods: dict) -> dict | None:
+        """
+        The pod of the request's path, None if there is no such pod in the path's namespace.
+        """
+
+        name = self.get_pod_name()
+        if name not in pods["names"] or pods["namespaces"].get(name, DEFAULT_NAMESPACE) != self.get_namespace():
+            return None
+        return pods["objects"].get(name, {})
+
+    def do_PATCH(self) -> None:
+        sleep(get_configuration(API_LATENCY_SECONDS_VARIABLE))
+        object_ = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        name = self.get_pod_name()
+        with self.lock:
+            pods = load_pods()
+            if name not in pods["names"]:
+                pods["names"].append(name)
+                pods["apply_time"] = time()
+            pods["namespaces"][name] = self.get_namespace()
+            pods["objects"][name] = object_
+            save_pods(pods)
+        self.send_json(200, object_)
+
+    def do_GET(self) -> None:
+        sleep(get_configuration(API_LATENCY_SECONDS_VARIABLE))
+        if "watch=true" in urlparse(self.path).query:
+            self.watch()
+            return
+        if self.get_pod_name() is None:
+            self.list()
+            return
+        pod_object = self.get_pod_object(load_pods())
+        if pod_object is None:
+            self.send_json(404, {"kind": "Status", "status": "Failure", "reason": "NotFound", "code": 404})
+            return
+        self.send_json(200, pod_object)
+
+    def do_DELETE(self) -> None:
+        sleep(get_configuration(API_LATENCY_SECONDS_VARIABLE))
+        self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        name = self.get_pod_name()
+        with self.lock:
+            pods = load_pods()
+            if self.get_pod_object(pods) is None:
+                self.send_json(404, {"kind": "Status", "status": "Failure", "reason": "NotFound", "code": 404})
+                return
+            pods["names"].remove(name)
+            pods["namespaces"].pop(name, None)
+            pods["objects"].pop(name, None)
+            save_pods(pods)
+        self.send_json(200, {"kind": "Status", "status": "Success"})
+
+    def list(self) -> None:
+        pods = load_pods()
+        timeline = get_pod_timeline()
+        passed = 0
+        if "apply_time" in pods:
+            passed = sum(1 for offset, _, _, _ in timeline if pods["apply_time"] + offset <= time())
+        items = []
+        if passed > 0:
+            _, phase, waiting_reason, ready = timeline[passed - 1]
+            items = [
+                make_pod_object(name, phase, waiting_reason, ready)
+                for name in get_watched_pod_names(pods, self.get_namespace())
+            ]
+        self.send_json(200, {"kind": "PodList", "metadata": {"resourceVersion": str(passed)}, "items": items})
+
+    def watch(self) -> None:
+        resource_version = int(parse_qs(urlparse(self.path).query).get("resourceVersion", ["0"])[0])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        pods = load_pods()
+        try:
+            for offset, phase, waiting_reason, ready in get_pod_timeline()[resource_version:]:
+                sleep(max(0.0, pods["apply_time"] + offset - time()))
+                for name in get_watched_pod_names(pods, self.get_namespace()):
+                    event = json.dumps(
+                        {"type": "MODIFIED", "object": make_pod_object(name, phase, waiting_reason, ready)}
+                    ).encode() + b"\n"
+                    self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+                    self.wfile.flush()
+            # like the real api server, keeps watching until the client disconnects
+            while self.rfile.read(1) != b"":
+                pass
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+
+def serve_fake_kubernetes_api(state_directory: str) -> str:
+    """
+    Serves the stub kubernetes api server in background threads of the current process.
+    Returns the filename of a kubeconfig pointing to it.
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeKubernetesApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    kubeconfig_filename = os.path.join(state_directory, "kubeconfig")
+    with open(kubeconfig_filename, "w") as f:
+        json.dump(
+            {
+                "apiVersion": "v1",
+                "kind": "Config",
+                "current-context": "fake",
+                "clusters": [{"name": "fake", "cluster": {"server": f"http://127.0.0.1:{server.server_address[1]}"}}],
+                "users": [{"name": "fake", "user": {"token": "fake-token"}}],
+                "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake", "namespace": DEFAULT_NAMESPACE}}],
+            },
+            f,
+        )
+    return kubeconfig_filename
@@ -0,0 +1,440 @@
+import os
+import ssl
+import atexit
+import shutil
+import json
+import base64
+import socket
+import tempfile
+import subprocess
+import http.client
+from abc import ABC, abstractmethod
+from queue import Queue
+from threading import Lock, Thread
+from time import sleep, monotonic
+from urllib.parse import urlparse, urlencode
+from dataclasses import dataclass
+from typing import Callable, Iterator
+import yaml
+from beartype import beartype
+
+
+DEFAULT_KUBECONFIG_FILENAME: str = os.path.expanduser("~/.kube/config")
+# the name under which the fields set by setup.py's server-side applies are owned
+FIELD_MANAGER: str = "sfcompute"
+# the configuration kubectl apply records on each object, which the api backend records too,
+# so that a restart can tell which pods changed whichever backend applied them
+LAST_APPLIED_ANNOTATION: str = "kubectl.kubernetes.io/last-applied-configuration"
+
+# the kinds the api backend can apply, all in the core api group, and their resource names
+CORE_RESOURCES: dict[str, str] = {
+    "Pod": "pods",
+    "Service": "services",
+    "ConfigMap": "configmaps",
+    "Secret": "secrets",
+    "PersistentVolumeClaim": "persistentvolumeclaims",
+}
+
+DELETE_GRACE_PERIOD_SECONDS: int = 5
+DELETE_TIMEOUT_SECONDS: float = 600.0
+POLL_INTERVAL_SECONDS: float = 1.0
+# how many times in a row a watch of the pods may fail to (re)connect before it gives up
+MAX_WATCH_RETRIES: int = 5
+
+
+class KubernetesBackend(ABC):
+    """
+    What setup.py does with the cluster. `KubernetesApiBackend` talks to the api server directly,
+    and setup.py's `KubectlBackend` runs kubectl, for the kubeconfigs the api backend does not support.
+    """
+
+    name: str = ""
+
+    @abstractmethod
+    def apply(self, objects: list[dict]) -> None: ...
+
+    @abstractmethod
+    def get_last_applied(self, pod_objects: list[dict]) -> dict[str, dict]:
+        """
+        The pods of `pod_objects` which exist in the cluster, as they were last applied, by name.
+        """
+
+    @abstractmethod
+    def delete(self, objects: list[dict], wait: bool = True) -> None: ...
+
+    @abstractmethod
+    def watch_pods(self, pod_objects: Queue, namespaces: list[str | None]) -> Callable[[], None]:
+        """
+        Puts every version of every pod of `namespaces` in `pod_objects` as the cluster reports them,
+        then None when a watch ends. None in `namespaces` is the namespace of the current context.
+        Returns a function which stops the watches.
+        """
+
+
+@beartype
+@dataclass(frozen=True)
+class KubeConfig:
+    # e.g. https://1.2.3.4:6443
+    server: str
+    namespace: str
+    token: str | None = None
+    certificate_authority_filename: str | None = None
+    client_certificate_filename: str | None = None
+    client_key_filename: str | None = None
+    insecure_skip_tls_verify: bool = False
+
+
+@beartype
+def get_kubeconfig_filename() -> str:
+    """
+    The first file of $KUBECONFIG, like kubectl when it does not merge several files.
+    """
+
+    filenames = [filename for filename in os.environ.get("KUBECONFIG", "").split(":") if filename != ""]
+    return filenames[0] if len(filenames) > 0 else DEFAULT_KUBECONFIG_FILENAME
+
+
+@beartype
+def write_credential_file(data: str, directory: str, name: str) -> str:
+    """
+    ssl only loads client certificates from files, so the ones embedded in the kubeconfig are written to `directory`.
+    """
+
+    filename = os.path.join(directory, name)
+    with open(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+        f.write(data.encode() if data.startswith("-----BEGIN") else base64.b64decode(data))
+    return filename
+
+
+@beartype
+def run_exec_credential_plugin(exec_config: dict) -> dict:
+    """
+    The `status` of the ExecCredential printed by the kubeconfig's credential plugin.
+    """
+
+    environment = {**os.environ, **{variable["name"]: variable["value"] for variable in exec_config.get("env") or []}}
+    output = subprocess.run(
+        [exec_config["command"], *(exec_config.get("args") or [])],
+        env=environment,
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output)["status"]
+
+
+@beartype
+def load_kubeconfig(filename: str | None = None) -> KubeConfig | None:
+    """
+    The server and credentials of the current context.
+    None if there is no kubeconfig or it authenticates in a way only kubectl supports (e.g. auth providers).
+    """
+
+    if filename is None:
+        filename = get_kubeconfig_filename()
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        kubeconfig = yaml.safe_load(f) or {}
+
+    def find(section: str, name: str | None) -> dict:
+        for entry in kubeconfig.get(section) or []:
+            if entry["name"] == name:
+                return entry[section.removesuffix("s")] or {}
+        return {}
+
+    context = find("contexts", kubeconfig.get("current-context"))
+    cluster = find("clusters", context.get("cluster"))
+    user = find("users", context.get("user"))
+    if "server" not in cluster or "auth-provider" in user or "username" in user:
+        return None
+
+    # the client key is a secret, so it does not outlive setup.py
+    directory = tempfile.mkdtemp(prefix="sfcompute-kubeconfig-")
+    atexit.register(shutil.rmtree, directory, True)
+    certificate_authority_filename = cluster.get("certificate-authority")
+    if "certificate-authority-data" in cluster:
+        certificate_authority_filename = write_credential_file(cluster["certificate-authority-data"], directory, "ca.crt")
+
+    token = user.get("token")
+    if "tokenFile" in user:
+        with open(user["tokenFile"]) as f:
+            token = f.read().strip()
+    client_certificate_filename = user.get("client-certificate")
+    client_key_filename = user.get("client-key")
+    if "client-certificate-data" in user:
+        client_certificate_filename = write_credential_file(user["client-certificate-data"], directory, "client.crt")
+    if "client-key-data" in user:
+        client_key_filename = write_credential_file(user["client-key-data"], directory, "client.key")
+    if "exec" in user:
+        status = run_exec_credential_plugin(user["exec"])
+        token = status.get("token", token)
+        if "clientCertificateData" in status:
+            client_certificate_filename = write_credential_file(status["clientCertificateData"], directory, "client.crt")
+            client_key_filename = write_credential_file(status["clientKeyData"], directory, "client.key")
+
+    return KubeConfig(
+        server=cluster["server"].rstrip("/"),
+        namespace=context.get("namespace") or "default",
+        token=token,
+        certificate_authority_filename=certificate_authority_filename,
+        client_certificate_filename=client_certificate_filename,
+        client_key_filename=client_key_filename,
+        insecure_skip_tls_verify=bool(cluster.get("insecure-skip-tls-verify", False)),
+    )
+
+
+class KubernetesApiError(Exception):
+    def __init__(self, method: str, path: str, status: int, body: dict) -> None:
+        self.status = status
+        super().__init__(f"{method} {path} failed with status {status}: {body.get('message', body)}")
+
+
+class KubernetesApiClient:
+    """
+    Keeps one authenticated connection to the api server open and sends json requests over it.
+    Requests from several threads are sent one at a time. Watches each get their own connection.
+    """
+
+    @beartype
+    def __init__(self, config: KubeConfig) -> None:
+        self.config = config
+        url = urlparse(config.server)
+        assert url.scheme in ["http", "https"], f"Unsupported kubernetes api server {config.server}."
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.path_prefix = url.path.rstrip("/")
+        self.ssl_context: ssl.SSLContext | None = None
+        if url.scheme == "https":
+            self.ssl_context = ssl.create_default_context(cafile=config.certificate_authority_filename)
+            if config.insecure_skip_tls_verify:
+                self.ssl_context.check_hostname = False
+                self.ssl_context.verify_mode = ssl.CERT_NONE
+            if config.client_certificate_filename is not None:
+                self.ssl_context.load_cert_chain(config.client_certificate_filename, config.client_key_filename)
+        self.lock = Lock()
+        self.connection: http.client.HTTPConnection | None = None
+
+    @beartype
+    def connect(self, timeout: float | None = 60.0) -> http.client.HTTPConnection:
+        if self.ssl_context is not None:
+            return http.client.HTTPSConnection(self.host, self.port, context=self.ssl_context, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    @beartype
+    def get_headers(self, content_type: str | None) -> dict[str, str]:
+        headers = {"Accept": "application/json", "User-Agent": "sfcompute-setup"}
+        if content_type is not None:
+            headers["Content-Type"] = content_type
+        if self.config.token is not None:
+            headers["Authorization"] = f"Bearer {self.config.token}"
+        return headers
+
+    @beartype
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: dict | None = None,
+        content_type: str = "application/json",
+        allowed_statuses: list[int] | None = None,
+    ) -> dict:
+        """
+        The json response. Raises KubernetesApiError if the status is not 2xx or in `allowed_statuses`.
+        The request is sent again over a new connection if the open one was closed.
+        """
+
+        data = json.dumps(body).encode() if body is not None else None
+        with self.lock:
+            for attempt in range(2):
+                if self.connection is None:
+                    self.connection = self.connect()
+                try:
+                    self.connection.request(
+                        method,
+                        self.path_prefix + path,
+                        body=data,
+                        headers=self.get_headers(content_type if data is not None else None),
+                    )
+                    response = self.connection.getresponse()
+                    response_data = response.read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    self.connection.close()
+                    self.connection = None
+                    if attempt == 1:
+                        raise
+        response_body = json.loads(response_data) if response_data.strip() else {}
+        if not (200 <= response.status < 300 or response.status in (allowed_statuses if allowed_statuses is not None else [])):
+            raise KubernetesApiError(method, path, response.status, response_body)
+        return response_body
+
+    @beartype
+    def watch(self, path: str, on_connect: Callable[[http.client.HTTPConnection], None]) -> Iterator[dict]:
+        """
+        The events of a watch, which the api server sends as one json object per line.
+        `on_connect` gets the watch's connection, so that another thread can close it to stop the watch.
+        """
+
+        connection = self.connect(timeout=None)
+        on_connect(connection)
+        try:
+            connection.request("GET", self.path_prefix + path, headers=self.get_headers(None))
+            response = connection.getresponse()
+            if response.status != 200:
+                raise KubernetesApiError("GET", path, response.status, json.loads(response.read() or b"{}"))
+            for line in response:
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            connection.close()
+
+
+@beartype
+def get_object_path(object_: dict, default_namespace: str) -> str:
+    kind = object_["kind"]
+    assert kind in CORE_RESOURCES and object_.get("apiVersion", "v1") == "v1", (
+        f"The kubernetes api backend cannot apply {object_.get('apiVersion')} {kind}, use the kubectl backend."
+    )
+    namespace = object_["metadata"].get("namespace") or default_namespace
+    return f"/api/v1/namespaces/{namespace}/{CORE_RESOURCES[kind]}/{object_['metadata']['name']}"
+
+
+@beartype
+def can_apply(objects: list[dict]) -> bool:
+    return all(object_.get("kind") in CORE_RESOURCES and object_.get("apiVersion", "v1") == "v1" for object_ in objects)
+
+
+@beartype
+def with_last_applied_annotation(object_: dict) -> dict:
+    """
+    `object_` with the annotation kubectl apply would record on it, which is the object without that annotation.
+    """
+
+    annotations = {
+        name: value
+        for name, value in (object_["metadata"].get("annotations") or {}).items()
+        if name != LAST_APPLIED_ANNOTATION
+    }
+    metadata = {name: value for name, value in object_["metadata"].items() if name != "annotations"}
+    original = {**object_, "metadata": {**metadata, "annotations": annotations} if len(annotations) > 0 else metadata}
+    last_applied = json.dumps(original, separators=(",", ":"))
+    return {**object_, "metadata": {**metadata, "annotations": {**annotations, LAST_APPLIED_ANNOTATION: last_applied}}}
+
+
+class KubernetesApiBackend(KubernetesBackend):
+    name = "api"
+
+    @beartype
+    def __init__(self, config: KubeConfig) -> None:
+        self.config = config
+        self.client = KubernetesApiClient(config)
+
+    @beartype
+    def apply(self, objects: list[dict]) -> None:
+        """
+        Server-side applies every object over the one open connection.
+        """
+
+        for object_ in objects:
+            path = get_object_path(object_, self.config.namespace)
+            # json is yaml, which is what apply patches are
+            self.client.request(
+                "PATCH",
+                path + "?" + urlencode({"fieldManager": FIELD_MANAGER, "force": "true"}),
+                body=with_last_applied_annotation(object_),
+                content_type="application/apply-patch+yaml",
+            )
+            print(f"{object_['kind'].lower()}/{object_['metadata']['name']} serverside-applied", flush=True)
+
+    @beartype
+    def get_last_applied(self, pod_objects: list[dict]) -> dict[str, dict]:
+        last_applied: dict[str, dict] = {}
+        for pod_object in pod_objects:
+            live = self.client.request(
+                "GET", get_object_path(pod_object, self.config.namespace), allowed_statuses=[404]
+            )
+            if live.get("kind") != "Pod":
+                continue
+            annotation = (live["metadata"].get("annotations") or {}).get(LAST_APPLIED_ANNOTATION, "{}")
+            last_applied[live["metadata"]["name"]] = json.loads(annotation)
+        return last_applied
+
+    @beartype
+    def delete(self, objects: list[dict], wait: bool = True) -> None:
+        paths = [get_object_path(object_, self.config.namespace) for object_ in objects]
+        for path in paths:
+            self.client.request(
+                "DELETE",
+                path,
+                body={"gracePeriodSeconds": DELETE_GRACE_PERIOD_SECONDS, "propagationPolicy": "Background"},
+                allowed_statuses=[404],
+            )
+        start_time = monotonic()
+        while wait and len(paths) > 0:
+            # a 404 is answered with a Status object
+            paths = [
+                path
+                for path in paths
+                if self.client.request("GET", path, allowed_statuses=[404]).get("kind") != "Status"
+            ]
+            if len(paths) == 0:
+                break
+            assert monotonic() - start_time < DELETE_TIMEOUT_SECONDS, (
+                f"{paths} still exist {DELETE_TIMEOUT_SECONDS} seconds after they were deleted."
+            )
+            sleep(POLL_INTERVAL_SECONDS)
+
+    @beartype
+    def watch_pods(self, pod_objects: Queue, namespaces: list[str | None]) -> Callable[[], None]:
+        connections: list[http.client.HTTPConnection] = []
+        stopped: list[bool] = [False]
+
+        def watch(namespace: str) -> None:
+            """
+            Lists the pods and watches them from the list's resourceVersion. The api server ends watches on its
+            timeout, and with an ERROR event when the resourceVersion is too old (410 Gone), so the pods are then
+            listed and watched again. Gives up after `MAX_WATCH_RETRIES` failures in a row.
+            """
+
+            path = f"/api/v1/namespaces/{namespace}/pods"
+            failures = 0
+            try:
+                while not stopped[0]:
+                    try:
+                        pod_list = self.client.request("GET", path)
+                        for pod_object in pod_list["items"]:
+                            pod_objects.put(pod_object)
+                        query = urlencode(
+                            {
+                                "watch": "true",
+                                "resourceVersion": pod_list["metadata"]["resourceVersion"],
+                                "allowWatchBookmarks": "true",
+                            }
+                        )
+                        for event in self.client.watch(f"{path}?{query}", on_connect=connections.append):
+                            if event.get("type") == "ERROR":
+                                raise KubernetesApiError("GET", path, event["object"].get("code", 0), event["object"])
+                            failures = 0
+                            if event.get("type") != "BOOKMARK":
+                                pod_objects.put(event["object"])
+                    except (KubernetesApiError, http.client.HTTPException, OSError, ValueError):
+                        if stopped[0]:
+                            return
+                        failures += 1
+                        if failures >= MAX_WATCH_RETRIES:
+                            raise
+                        sleep(POLL_INTERVAL_SECONDS)
+            finally:
+                pod_objects.put(None)
+
+        def stop() -> None:
+            stopped[0] = True
+            for connection in connections:
+                if connection.sock is not None:
+                    connection.sock.shutdown(socket.SHUT_RDWR)
+
+        for namespace in dict.fromkeys(namespace or self.config.namespace for namespace in namespaces):
+            Thread(target=watch, args=(namespace,), daemon=True).start()
+        return stop
@@ -0,0 +1,476 @@
+import os
+import sys
+import csv
+import subprocess
+from queue import Queue, Empty
+from threading import Thread
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from statistics import median
+from time import sleep, time, monotonic, strftime
+from beartype import beartype
+
+import setup
+import port_forward
+from setup import Pod
+
+
+MONITOR_DIRECTORY: str = os.path.join(port_forward.STATE_DIRECTORY, "monitor")
+DEFAULT_INTERVAL_SECONDS: float = 5.0
+RECONNECT_SECONDS: float = 5.0
+
+SAMPLE_START_MARKER: str = "=== SFCOMPUTE SAMPLE ==="
+SAMPLE_END_MARKER: str = "=== SFCOMPUTE SAMPLE END ==="
+SECTION_PREFIX: str = "--- "
+
+NVIDIA_SMI_QUERY: str = "index,utilization.gpu,memory.used,memory.total,temperature.gpu,power.draw"
+# the disks whose usage is sampled, /data is the pods' emptyDir and /dev/shm is in memory
+DISKS: list[str] = ["/dev/shm", "/data"]
+
+# the columns of the time series file, one row per sample of each pod
+COLUMNS: list[str] = [
+    "time",
+    "pod",
+    "n_gpus",
+    "gpu_utilization_percent",
+    "gpu_min_utilization_percent",
+    "gpu_memory_used_percent",
+    "gpu_max_temperature_celsius",
+    "gpu_power_watts",
+    "cpu_percent",
+    "load_1m",
+    "memory_used_percent",
+    "shm_used_percent",
+    "data_used_percent",
+]
+
+# a pod is an outlier on a column if it is further than this from the median of the other pods
+OUTLIER_THRESHOLDS: dict[str, float] = {
+    "gpu_utilization_percent": 25.0,
+    "gpu_min_utilization_percent": 25.0,
+    "gpu_memory_used_percent": 25.0,
+    "cpu_percent": 25.0,
+    "memory_used_percent": 25.0,
+    "shm_used_percent": 25.0,
+    "data_used_percent": 25.0,
+}
+
+
+@beartype
+def get_sample_command(interval_seconds: float) -> str:
+    """
+    Prints one sample between markers every `interval_seconds`, for as long as the ssh session lasts.
+    The loop ends when a write fails because the session was closed.
+    """
+
+    return (
+        "while true; do {"
+        + f" echo '{SAMPLE_START_MARKER}';"
+        + f" echo '{SECTION_PREFIX}nvidia-smi'; nvidia-smi --query-gpu={NVIDIA_SMI_QUERY} --format=csv,noheader,nounits 2>/dev/null;"
+        + f" echo '{SECTION_PREFIX}loadavg'; cat /proc/loadavg;"
+        + f" echo '{SECTION_PREFIX}stat'; head -n 1 /proc/stat;"
+        + f" echo '{SECTION_PREFIX}meminfo'; grep -E '^(MemTotal|MemAvailable):' /proc/meminfo;"
+        + f" echo '{SECTION_PREFIX}df'; df -B1 --output=target,size,used {' '.join(DISKS)} 2>/dev/null;"
+        + f" echo '{SAMPLE_END_MARKER}';"
+        + f" }} || exit 0; sleep {interval_seconds}; done"
+    )
+
+
+@beartype
+@dataclass(frozen=True)
+class GpuSample:
+    index: int
+    utilization_percent: float
+    memory_used_bytes: int
+    memory_total_bytes: int
+    temperature_celsius: float
+    # None if the gpu does not report it
+    power_watts: float | None
+
+
+@beartype
+@dataclass(frozen=True)
+class DiskSample:
+    size_bytes: int
+    used_bytes: int
+
+
+@beartype
+@dataclass(frozen=True)
+class PodSample:
+    time: float
+    pod_name: str
+    gpus: list[GpuSample]
+    load_1m: float
+    # the cumulative busy and total cpu time since boot, from /proc/stat
+    cpu_busy_jiffies: int
+    cpu_total_jiffies: int
+    memory_total_bytes: int
+    memory_available_bytes: int
+    disks: dict[str, DiskSample]
+
+
+@beartype
+def parse_number(field: str) -> float | None:
+    """
+    nvidia-smi prints e.g. `[N/A]` or `[Not Supported]` for values a gpu does not report.
+    """
+
+    try:
+        return float(field)
+    except ValueError:
+        return None
+
+
+@beartype
+def parse_nvidia_smi(lines: list[str]) -> list[GpuSample]:
+    """
+    Parses the output of `nvidia-smi --query-gpu=NVIDIA_SMI_QUERY --format=csv,noheader,nounits`, where memory is in MiB.
+    """
+
+    gpus: list[GpuSample] = []
+    for line in lines:
+        if line.strip() == "":
+            continue
+        fields = [field.strip() for field in line.split(",")]
+        assert len(fields) == len(NVIDIA_SMI_QUERY.split(",")), f"Unexpected nvidia-smi output line {line!r}."
+        index, utilization, memory_used, memory_total, temperature, power = fields
+        gpus.append(
+            GpuSample(
+                index=int(index),
+                utilization_percent=parse_number(utilization) or 0.0,
+                memory_used_bytes=int((parse_number(memory_used) or 0.0) * 2**20),
+                memory_total_bytes=int((parse_number(memory_total) or 0.0) * 2**20),
+                temperature_celsius=parse_number(temperature) or 0.0,
+                power_watts=parse_number(power),
+            )
+        )
+    return gpus
+
+
+@beartype
+def parse_cpu_jiffies(stat_line: str) -> tuple[int, int]:
+    """
+    The busy and total cpu time in the `cpu` line of /proc/stat. Idle and iowait are not busy.
+    """
+
+    fields = stat_line.split()
+    assert fields[0] == "cpu", f"Unexpected /proc/stat line {stat_line!r}."
+    # guest time is already counted in user time
+    jiffies = [int(field) for field in fields[1:9]]
+    idle = jiffies[3] + jiffies[4]
+    return sum(jiffies) - idle, sum(jiffies)
+
+
+@beartype
+def parse_meminfo(lines: list[str]) -> dict[str, int]:
+    """
+    The fields of /proc/meminfo in bytes.
+    """
+
+    fields: dict[str, int] = {}
+    for line in lines:
+        name, value = line.split(":", 1)
+        amount, *unit = value.split()
+        fields[name] = int(amount) * (1024 if unit == ["kB"] else 1)
+    return fields
+
+
+@beartype
+def parse_df(lines: list[str]) -> dict[str, DiskSample]:
+    """
+    Parses the output of `df -B1 --output=target,size,used`, by mount point.
+    """
+
+    disks: dict[str, DiskSample] = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) != 3 or not fields[1].isdigit():
+            # the header
+            continue
+        disks[fields[0]] = DiskSample(size_bytes=int(fields[1]), used_bytes=int(fields[2]))
+    return disks
+
+
+@beartype
+def split_sections(lines: list[str]) -> dict[str, list[str]]:
+    sections: dict[str, list[str]] = {}
+    section: list[str] | None = None
+    for line in lines:
+        if line.startswith(SECTION_PREFIX):
+            section = sections.setdefault(line.removeprefix(SECTION_PREFIX).strip(), [])
+        elif section is not None:
+            section.append(line)
+    return sections
+
+
+@beartype
+def parse_sample(lines: list[str], pod_name: str, sample_time: float) -> PodSample:
+    """
+    Parses the lines `get_sample_command` prints between the markers.
+    """
+
+    sections = split_sections(lines)
+    cpu_busy_jiffies, cpu_total_jiffies = parse_cpu_jiffies(sections["stat"][0])
+    meminfo = parse_meminfo(sections["meminfo"])
+    return PodSample(
+        time=sample_time,
+        pod_name=pod_name,
+        gpus=parse_nvidia_smi(sections.get("nvidia-smi", [])),
+        load_1m=float(sections["loadavg"][0].split()[0]),
+        cpu_busy_jiffies=cpu_busy_jiffies,
+        cpu_total_jiffies=cpu_total_jiffies,
+        memory_total_bytes=meminfo["MemTotal"],
+        memory_available_bytes=meminfo["MemAvailable"],
+        disks=parse_df(sections.get("df", [])),
+    )
+
+
+@beartype
+def percent(part: int | float, total: int | float) -> float | None:
+    return 100 * part / total if total > 0 else None
+
+
+@beartype
+def get_row(sample: PodSample, previous_sample: PodSample | None) -> dict[str, float | int | str | None]:
+    """
+    The values of `COLUMNS` for one sample. The cpu usage is over the time since the previous sample of the pod,
+    so it is None for the first one.
+    """
+
+    gpus = sample.gpus
+    cpu_percent = None
+    if previous_sample is not None:
+        cpu_percent = percent(
+            sample.cpu_busy_jiffies - previous_sample.cpu_busy_jiffies,
+            sample.cpu_total_jiffies - previous_sample.cpu_total_jiffies,
+        )
+    disk_used_percent = {
+        mount_point: percent(disk.used_bytes, disk.size_bytes) for mount_point, disk in sample.disks.items()
+    }
+    return {
+        "time": sample.time,
+        "pod": sample.pod_name,
+        "n_gpus": len(gpus),
+        "gpu_utilization_percent": sum(gpu.utilization_percent for gpu in gpus) / len(gpus) if gpus else None,
+        "gpu_min_utilization_percent": min(gpu.utilization_percent for gpu in gpus) if gpus else None,
+        "gpu_memory_used_percent": percent(
+            sum(gpu.memory_used_bytes for gpu in gpus), sum(gpu.memory_total_bytes for gpu in gpus)
+        ),
+        "gpu_max_temperature_celsius": max(gpu.temperature_celsius for gpu in gpus) if gpus else None,
+        "gpu_power_watts": sum(gpu.power_watts for gpu in gpus if gpu.power_watts is not None) if gpus else None,
+        "cpu_percent": cpu_percent,
+        "load_1m": sample.load_1m,
+        "memory_used_percent": percent(
+            sample.memory_total_bytes - sample.memory_available_bytes, sample.memory_total_bytes
+        ),
+        "shm_used_percent": disk_used_percent.get("/dev/shm"),
+        "data_used_percent": disk_used_percent.get("/data"),
+    }
+
+
+@beartype
+def find_outliers(rows: dict[str, dict[str, float | int | str | None]]) -> dict[str, set[str]]:
+    """
+    The columns on which each pod is further than `OUTLIER_THRESHOLDS` from the median of the other pods.
+    Needs at least two other pods with a value, so that the median means something.
+    """
+
+    outliers: dict[str, set[str]] = {pod_name: set() for pod_name in rows}
+    for column, threshold in OUTLIER_THRESHOLDS.items():
+        for pod_name, row in rows.items():
+            value = row[column]
+            others = [
+                other_row[column]
+                for other_pod_name, other_row in rows.items()
+                if other_pod_name != pod_name and other_row[column] is not None
+            ]
+            if value is None or len(others) < 2:
+                continue
+            if abs(value - median(others)) > threshold:  # type: ignore
+                outliers[pod_name].add(column)
+    return outliers
+
+
+@beartype
+def format_value(value: float | int | str | None, format_spec: str) -> str:
+    return "-" if value is None else format(value, format_spec)
+
+
+@beartype
+def format_csv_value(value: float | int | str | None) -> str:
+    """
+    Rounded to keep the file small, the samples are not more precise than that anyway.
+    """
+
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:.3f}".rstrip("0").rstrip(".")
+    return str(value)
+
+
+# the columns of the live summary: header, column of the time series file, format
+SUMMARY_COLUMNS: list[tuple[str, str, str]] = [
+    ("GPU%", "gpu_utilization_percent", ".0f"),
+    ("MIN GPU%", "gpu_min_utilization_percent", ".0f"),
+    ("GPU MEM%", "gpu_memory_used_percent", ".0f"),
+    ("MAX °C", "gpu_max_temperature_celsius", ".0f"),
+    ("WATTS", "gpu_power_watts", ".0f"),
+    ("CPU%", "cpu_percent", ".0f"),
+    ("LOAD", "load_1m", ".1f"),
+    ("MEM%", "memory_used_percent", ".0f"),
+    ("SHM%", "shm_used_percent", ".0f"),
+    ("DATA%", "data_used_percent", ".0f"),
+]
+
+
+@beartype
+def format_summary(
+    pods: list[Pod], rows: dict[str, dict[str, float | int | str | None]], color: bool
+) -> str:
+    """
+    One line per pod with its latest sample. Outliers are in red with `color`, and followed by a `!` otherwise.
+    """
+
+    outliers = find_outliers(rows)
+    name_width = max(len(pod.name) for pod in pods)
+    lines = [f"{'POD':<{name_width}}  " + "  ".join(f"{header:>9}" for header, _, _ in SUMMARY_COLUMNS)]
+    for pod in pods:
+        if pod.name not in rows:
+            lines.append(f"{pod.name:<{name_width}}  NO SAMPLE YET")
+            continue
+        cells: list[str] = []
+        for _, column, format_spec in SUMMARY_COLUMNS:
+            cell = format_value(rows[pod.name][column], format_spec)
+            if column in outliers[pod.name]:
+                cell = f"\033[1;31m{cell:>9}\033[0m" if color else f"{cell + '!':>9}"
+            else:
+                cell = f"{cell:>9}"
+            cells.append(cell)
+        lines.append(f"{pod.name:<{name_width}}  " + "  ".join(cells))
+    n_outliers = sum(len(columns) > 0 for columns in outliers.values())
+    if n_outliers > 0:
+        lines.append(f"=== {n_outliers} PODS ARE FAR FROM THE MEDIAN OF THE OTHER PODS ON THE HIGHLIGHTED COLUMNS ===")
+    return "\n".join(lines)
+
+
+@beartype
+def stream_samples(
+    pod: Pod, interval_seconds: float, samples: Queue, processes: dict[str, subprocess.Popen]
+) -> None:
+    """
+    Keeps one ssh (or kubectl exec) session open to the pod which prints a sample every `interval_seconds`, and puts the
+    parsed samples in `samples`. Reconnects if the session ends. The process is in `processes`, so that it can be stopped.
+    """
+
+    while True:
+        process = processes[pod.name] = subprocess.Popen(
+            setup.get_remote_command(pod, get_sample_command(interval_seconds), multiplexed=False),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        assert process.stdout is not None
+        lines: list[str] | None = None
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            if line == SAMPLE_START_MARKER:
+                lines = []
+            elif line == SAMPLE_END_MARKER and lines is not None:
+                try:
+                    samples.put(parse_sample(lines, pod.name, time()))
+                except (AssertionError, KeyError, IndexError, ValueError) as e:
+                    print(f"=== COULD NOT PARSE A SAMPLE FROM POD {pod.name}: {e!r} ===", flush=True)
+                lines = None
+            elif lines is not None:
+                lines.append(line)
+        process.wait()
+        print(f"=== THE SESSION TO POD {pod.name} ENDED, RECONNECTING IN {RECONNECT_SECONDS:.0f}s ===", flush=True)
+        sleep(RECONNECT_SECONDS)
+
+
+@beartype
+def monitor(
+    pods: list[Pod],
+    interval_seconds: float = DEFAULT_INTERVAL_SECONDS,
+    output_filename: str | None = None,
+    duration_seconds: float | None = None,
+) -> str:
+    """
+    Samples all pods every `interval_seconds`, appends the samples to a CSV file with one column per metric and
+    prints a summary of the latest sample of each pod after each interval. Runs until interrupted or until
+    `duration_seconds` passed. Returns the CSV file's name.
+    The file is opened once and flushed after each interval, so that it can be read while the monitor runs.
+    It stays a CSV rather than a columnar format like parquet, which cannot be appended to sample by sample
+    and would add a dependency.
+    """
+
+    if output_filename is None:
+        output_filename = os.path.join(MONITOR_DIRECTORY, f"{strftime('%Y%m%d-%H%M%S')}.csv")
+    os.makedirs(os.path.dirname(output_filename) or ".", exist_ok=True)
+    write_header = not os.path.exists(output_filename) or os.path.getsize(output_filename) == 0
+    color = sys.stdout.isatty()
+
+    samples: Queue = Queue()
+    processes: dict[str, subprocess.Popen] = {}
+    for pod in pods:
+        Thread(target=stream_samples, args=(pod, interval_seconds, samples, processes), daemon=True).start()
+
+    previous_samples: dict[str, PodSample] = {}
+    rows: dict[str, dict[str, float | int | str | None]] = {}
+    start_time = monotonic()
+    next_summary_time = start_time + interval_seconds
+    with open(output_filename, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        if write_header:
+            writer.writeheader()
+        try:
+            while duration_seconds is None or monotonic() - start_time < duration_seconds:
+                try:
+                    sample: PodSample = samples.get(timeout=max(0.0, next_summary_time - monotonic()))
+                except Empty:
+                    pass
+                else:
+                    row = get_row(sample, previous_samples.get(sample.pod_name))
+                    previous_samples[sample.pod_name] = sample
+                    rows[sample.pod_name] = row
+                    writer.writerow({column: format_csv_value(value) for column, value in row.items()})
+                if monotonic() >= next_summary_time:
+                    f.flush()
+                    next_summary_time += interval_seconds
+                    print(
+                        ("\033[H\033[J" if color else "")
+                        + f"=== {strftime('%H:%M:%S')}, WRITING TO {output_filename} ===\n"
+                        + format_summary(pods, rows, color=color),
+                        flush=True,
+                    )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes.values():
+                process.terminate()
+    print(f"=== THE SAMPLES ARE IN {output_filename} ===")
+    return output_filename
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Sample the gpu, cpu, memory, /dev/shm and /data usage of all the pods of the cluster set up by setup.py, over one ssh session per pod. The samples are appended to a CSV file and a summary where outliers are highlighted is printed after each interval."
+    )
+    parser.add_argument("--interval-seconds", type=float, default=DEFAULT_INTERVAL_SECONDS)
+    parser.add_argument(
+        "--output",
+        type=str,
+        help=f"The CSV file to append the samples to. Defaults to a new file in {MONITOR_DIRECTORY}.",
+    )
+    parser.add_argument("--duration-seconds", type=float, help="Stop after this long instead of running until interrupted.")
+    args = parser.parse_args()
+
+    monitor(
+        setup.get_pods_from_port_forwards(),
+        interval_seconds=args.interval_seconds,
+        output_filename=args.output,
+        duration_seconds=args.duration_seconds,
+    )
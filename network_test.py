@@ -0,0 +1,341 @@
+import os
+import re
+import json
+import statistics
+from dataclasses import dataclass
+from beartype import beartype
+
+import port_forward
+
+
+NETWORK_TEST_PORT: int = 29555
+REMOTE_SCRIPT_FILENAME: str = "/tmp/sfcompute_network_test.py"
+SERVER_PID_FILENAME: str = "/tmp/sfcompute_network_test_server.pid"
+RESULTS_PREFIX: str = "NETWORK TEST RESULT: "
+RESULTS_FILENAME: str = os.path.join(port_forward.STATE_DIRECTORY, "network_test.json")
+
+# the environment variables are written to this file on each pod, which .bashrc and the commands starting ray source,
+# since ray's workers inherit the environment of `ray start` and non-interactive shells do not read .bashrc
+ENVIRONMENT_FILENAME: str = "$HOME/.sfcompute/network_environment"
+SOURCE_ENVIRONMENT_COMMAND: str = f'if [ -f "{ENVIRONMENT_FILENAME}" ]; then . "{ENVIRONMENT_FILENAME}"; fi'
+ENVIRONMENT_FINGERPRINT: str = f'$(cat "{ENVIRONMENT_FILENAME}" 2>/dev/null | sha256sum | cut -c1-16)'
+
+# links slower than this fraction of the median link are reported
+SLOW_LINK_FRACTION: float = 0.5
+
+# runs on the pods with python3, with only the standard library
+# probe <peer ip>: the interface used to reach the peer, its speed, infiniband devices and nccl-tests
+# server <port> <seconds>: accepts connections until it is killed or after <seconds>,
+#     connections starting with S are drained and connections starting with E are echoed
+# throughput <peer ip> <port> <streams> <seconds>: sends as fast as possible over <streams> connections
+# latency <peer ip> <port> <count>: round trips of a single byte
+# all_to_all <port> <seconds> <peer ip>...: sends to all the peers at the same time, one connection each
+REMOTE_SCRIPT: str = r'''
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import struct
+import fcntl
+import threading
+import statistics
+
+PREFIX = "NETWORK TEST RESULT: "
+CHUNK = b"\0" * (1 << 20)
+
+
+def report(kind, **fields):
+    print(PREFIX + json.dumps({"kind": kind, **fields}), flush=True)
+
+
+def interface_ip(name):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        packed = fcntl.ioctl(s.fileno(), 0x8915, struct.pack("256s", name[:15].encode()))  # SIOCGIFADDR
+        return socket.inet_ntoa(packed[20:24])
+    except OSError:
+        return None
+    finally:
+        s.close()
+
+
+def probe(peer_ip):
+    # connecting a udp socket sends nothing, it only picks the route to the peer
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.connect((peer_ip, 9))
+    source_ip = s.getsockname()[0]
+    s.close()
+    interface = next((name for _, name in socket.if_nameindex() if interface_ip(name) == source_ip), None)
+    speed_mbps = None
+    try:
+        with open(f"/sys/class/net/{interface}/speed") as f:
+            speed_mbps = int(f.read().strip())
+    except (OSError, ValueError):
+        pass
+    infiniband = sorted(os.listdir("/sys/class/infiniband")) if os.path.isdir("/sys/class/infiniband") else []
+    report(
+        "probe",
+        interface=interface,
+        source_ip=source_ip,
+        speed_mbps=speed_mbps,
+        infiniband_devices=infiniband,
+        nccl_tests=shutil.which("all_reduce_perf"),
+    )
+
+
+def serve_connection(connection):
+    with connection:
+        mode = connection.recv(1)
+        if mode == b"E":
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while data := connection.recv(1):
+                connection.sendall(data)
+        else:
+            while connection.recv(1 << 20):
+                pass
+
+
+def server(port, seconds):
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("0.0.0.0", port))
+    listener.listen(256)
+    listener.settimeout(1.0)
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            connection, _ = listener.accept()
+        except socket.timeout:
+            continue
+        connection.settimeout(None)
+        threading.Thread(target=serve_connection, args=(connection,), daemon=True).start()
+
+
+def send_until(peer_ip, port, deadline, counts, index):
+    with socket.create_connection((peer_ip, port), timeout=10) as connection:
+        connection.sendall(b"S")
+        while time.monotonic() < deadline:
+            connection.sendall(CHUNK)
+            counts[index] += len(CHUNK)
+
+
+def send_in_parallel(targets, seconds):
+    counts = [0] * len(targets)
+    start = time.monotonic()
+    deadline = start + seconds
+    threads = [
+        threading.Thread(target=send_until, args=(peer_ip, port, deadline, counts, i))
+        for i, (peer_ip, port) in enumerate(targets)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) * 8 / 1e9 / (time.monotonic() - start)
+
+
+def throughput(peer_ip, port, streams, seconds):
+    gbps = send_in_parallel([(peer_ip, port)] * streams, seconds)
+    report("throughput", peer_ip=peer_ip, streams=streams, gbps=gbps)
+
+
+def latency(peer_ip, port, count):
+    with socket.create_connection((peer_ip, port), timeout=10) as connection:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.sendall(b"E")
+        round_trips = []
+        for _ in range(count):
+            start = time.perf_counter()
+            connection.sendall(b"x")
+            connection.recv(1)
+            round_trips.append(time.perf_counter() - start)
+    report("latency", peer_ip=peer_ip, median_us=statistics.median(round_trips) * 1e6)
+
+
+def all_to_all(port, seconds, peer_ips):
+    gbps = send_in_parallel([(peer_ip, port) for peer_ip in peer_ips], seconds)
+    report("all_to_all", peers=len(peer_ips), gbps=gbps)
+
+
+mode, arguments = sys.argv[1], sys.argv[2:]
+if mode == "probe":
+    probe(arguments[0])
+elif mode == "server":
+    server(int(arguments[0]), float(arguments[1]))
+elif mode == "throughput":
+    throughput(arguments[0], int(arguments[1]), int(arguments[2]), float(arguments[3]))
+elif mode == "latency":
+    latency(arguments[0], int(arguments[1]), int(arguments[2]))
+elif mode == "all_to_all":
+    all_to_all(int(arguments[0]), float(arguments[1]), arguments[2:])
+'''
+
+
+@beartype
+@dataclass(frozen=True)
+class NetworkProbe:
+    # None if no interface has the address used to reach the peer
+    interface: str | None
+    source_ip: str
+    speed_mbps: int | None
+    infiniband_devices: list[str]
+    # path of nccl-tests' all_reduce_perf, None if it is not installed
+    nccl_tests: str | None
+
+
+@beartype
+@dataclass(frozen=True)
+class LinkResult:
+    source: str
+    destination: str
+    single_stream_gbps: float | None
+    multi_stream_gbps: float | None
+    latency_us: float | None
+
+
+@beartype
+def parse_results(output: str, kind: str) -> list[dict]:
+    """
+    The results of kind `kind` printed by `REMOTE_SCRIPT`, in the order they were printed.
+    """
+
+    results: list[dict] = []
+    for line in output.splitlines():
+        if not line.startswith(RESULTS_PREFIX):
+            continue
+        result = json.loads(line.removeprefix(RESULTS_PREFIX))
+        if result["kind"] == kind:
+            results.append(result)
+    return results
+
+
+@beartype
+def parse_probe(output: str) -> NetworkProbe:
+    results = parse_results(output, "probe")
+    assert len(results) == 1, f"Could not parse the network probe from:\n{output[-2048:]}"
+    result = results[0]
+    return NetworkProbe(
+        interface=result["interface"],
+        source_ip=result["source_ip"],
+        speed_mbps=result["speed_mbps"],
+        infiniband_devices=list(result["infiniband_devices"]),
+        nccl_tests=result["nccl_tests"],
+    )
+
+
+@beartype
+def parse_throughput_gbps(output: str, streams: int) -> float | None:
+    results = [result for result in parse_results(output, "throughput") if result["streams"] == streams]
+    return float(results[-1]["gbps"]) if results else None
+
+
+@beartype
+def parse_latency_us(output: str) -> float | None:
+    results = parse_results(output, "latency")
+    return float(results[-1]["median_us"]) if results else None
+
+
+@beartype
+def parse_all_to_all_gbps(output: str) -> float | None:
+    results = parse_results(output, "all_to_all")
+    return float(results[-1]["gbps"]) if results else None
+
+
+@beartype
+def parse_nccl_tests_bus_bandwidth(output: str) -> float | None:
+    """
+    The average bus bandwidth in GB/s from the output of nccl-tests, e.g. all_reduce_perf, which ends with
+    `# Avg bus bandwidth    : 123.456`.
+    """
+
+    matches = re.findall(r"#\s*Avg bus bandwidth\s*:\s*([0-9.]+)", output)
+    return float(matches[-1]) if matches else None
+
+
+@beartype
+def select_socket_threads(
+    single_stream_gbps: float | None, multi_stream_gbps: float | None
+) -> tuple[int, int]:
+    """
+    NCCL_SOCKET_NTHREADS and NCCL_NSOCKS_PERTHREAD.
+    More sockets only help if one tcp stream cannot fill the link, which is when several streams are much faster than one.
+    NCCL caps their product at 64.
+    """
+
+    if single_stream_gbps is None or multi_stream_gbps is None or single_stream_gbps <= 0:
+        return 2, 2
+    speedup = multi_stream_gbps / single_stream_gbps
+    if speedup >= 2.0:
+        return 4, 4
+    if speedup >= 1.3:
+        return 2, 4
+    return 1, 2
+
+
+@beartype
+def select_network_environment(
+    probe: NetworkProbe,
+    single_stream_gbps: float | None,
+    multi_stream_gbps: float | None,
+) -> dict[str, str]:
+    """
+    The NCCL and Gloo environment variables for a pod.
+    The socket interface is the one used to reach the other pods, otherwise NCCL and Gloo may pick one the others cannot reach.
+    The socket threads only matter without infiniband, since NCCL then goes over tcp.
+    """
+
+    environment: dict[str, str] = {}
+    if probe.interface is not None:
+        environment["NCCL_SOCKET_IFNAME"] = probe.interface
+        environment["GLOO_SOCKET_IFNAME"] = probe.interface
+    if len(probe.infiniband_devices) == 0:
+        n_threads, n_sockets_per_thread = select_socket_threads(
+            single_stream_gbps, multi_stream_gbps
+        )
+        environment["NCCL_SOCKET_NTHREADS"] = str(n_threads)
+        environment["NCCL_NSOCKS_PERTHREAD"] = str(n_sockets_per_thread)
+    return environment
+
+
+@beartype
+def get_environment_file_content(environment: dict[str, str]) -> bytes:
+    return "".join(f"export {name}={value}\n" for name, value in sorted(environment.items())).encode()
+
+
+@beartype
+def get_source_environment_in_bashrc_command() -> str:
+    return f"grep -qxF '{SOURCE_ENVIRONMENT_COMMAND}' .bashrc 2>/dev/null || echo '{SOURCE_ENVIRONMENT_COMMAND}' >> .bashrc"
+
+
+@beartype
+def find_slow_links(links: list[LinkResult]) -> list[LinkResult]:
+    speeds = [link.multi_stream_gbps for link in links if link.multi_stream_gbps is not None]
+    if len(speeds) == 0:
+        return [link for link in links if link.multi_stream_gbps is None]
+    median = statistics.median(speeds)
+    return [
+        link
+        for link in links
+        if link.multi_stream_gbps is None or link.multi_stream_gbps < SLOW_LINK_FRACTION * median
+    ]
+
+
+@beartype
+def format_links(links: list[LinkResult]) -> str:
+    slow_links = find_slow_links(links)
+
+    def format_number(value: float | None, unit: str) -> str:
+        return f"{value:9.2f}{unit}" if value is not None else " " * (9 + len(unit))
+
+    name_width = max([len(link.source) for link in links] + [len(link.destination) for link in links] + [4])
+    lines = [
+        f"{'FROM':<{name_width}} {'TO':<{name_width}} {'1 STREAM':>14} {'N STREAMS':>14} {'LATENCY':>11}"
+    ]
+    for link in links:
+        lines.append(
+            f"{link.source:<{name_width}} {link.destination:<{name_width}} {format_number(link.single_stream_gbps, 'Gb/s')} {format_number(link.multi_stream_gbps, 'Gb/s')} {format_number(link.latency_us, 'us')}"
+            + ("  SLOW" if link in slow_links else "")
+        )
+    return "\n".join(lines)
@@ -0,0 +1,191 @@
+from queue import Queue
+from threading import Event, Semaphore, Thread
+from time import time
+from dataclasses import dataclass
+from typing import Any, Callable
+from beartype import beartype
+
+import tracing
+
+
+@beartype
+@dataclass(frozen=True)
+class Task:
+    name: str
+    # None for the tasks which something outside of the pipeline completes by calling `Pipeline.complete`
+    function: Callable[[], Any] | None
+    dependencies: list[str]
+    # None for the tasks which are not about a single pod
+    pod: str | None
+    # "work" tasks take one of the `max_concurrency` slots while they run,
+    # "wait" tasks wait for something outside of our control and take none
+    category: str
+
+
+@beartype
+@dataclass(frozen=True)
+class TaskTiming:
+    # seconds since the epoch
+    # when the dependencies were all done
+    ready_time: float
+    # when the task got a slot and started running
+    start_time: float
+    end_time: float
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.end_time - self.start_time
+
+
+class Pipeline:
+    """
+    Runs tasks as soon as the tasks they depend on are done, so that e.g. each pod moves on to its next setup step
+    as soon as its previous one is done instead of waiting for all the other pods.
+    If a task fails, no task starts anymore, the running ones are waited for (the "wait" tasks should return early
+    once `stopped` is set), and a single error lists every failed task.
+    """
+
+    @beartype
+    def __init__(self) -> None:
+        self.tasks: dict[str, Task] = {}
+        self.results: dict[str, Any] = {}
+        self.timings: dict[str, TaskTiming] = {}
+        self.stopped = Event()
+        # (task name, timing, result, error) of every task which finished, in the order they finished,
+        # with a timing of None for the tasks which were skipped because the pipeline stopped
+        self.finished: Queue = Queue()
+
+    @beartype
+    def add(
+        self,
+        name: str,
+        function: Callable[[], Any] | None,
+        dependencies: list[str] | None = None,
+        pod: str | None = None,
+        category: str = "work",
+    ) -> str:
+        assert name not in self.tasks, f"There is already a task named {name!r}."
+        assert category in ["work", "wait"]
+        if dependencies is None:
+            dependencies = []
+        for dependency in dependencies:
+            assert dependency in self.tasks, f"Task {name!r} depends on {dependency!r}, which is not added yet."
+        self.tasks[name] = Task(
+            name=name, function=function, dependencies=list(dependencies), pod=pod, category=category
+        )
+        return name
+
+    @beartype
+    def complete(self, name: str) -> None:
+        """
+        Completes a task which was added without a function. Can be called from any thread.
+        """
+
+        assert self.tasks[name].function is None
+        self.finished.put((name, TaskTiming(ready_time=time(), start_time=time(), end_time=time()), None, None))
+
+    @beartype
+    def result(self, name: str) -> Any:
+        return self.results[name]
+
+    @beartype
+    def run_task(self, task: Task, ready_time: float, slots: Semaphore) -> None:
+        if task.category == "work":
+            slots.acquire()
+            # the pipeline may have stopped while the task waited for a slot
+            if self.stopped.is_set():
+                slots.release()
+                self.finished.put((task.name, None, None, None))
+                return
+        start_time = time()
+        try:
+            if task.pod is not None:
+                with tracing.pod_context(task.pod), tracing.span(task.name, "task", pod=task.pod):
+                    result = task.function()  # type: ignore
+            else:
+                with tracing.span(task.name):
+                    result = task.function()  # type: ignore
+            self.finished.put((task.name, TaskTiming(ready_time, start_time, time()), result, None))
+        except Exception as e:
+            self.finished.put((task.name, TaskTiming(ready_time, start_time, time()), None, e))
+        finally:
+            if task.category == "work":
+                slots.release()
+
+    @beartype
+    def run(self, max_concurrency: int) -> None:
+        assert max_concurrency >= 1
+
+        slots = Semaphore(max_concurrency)
+        started: set[str] = set()
+        running: set[str] = set()
+        errors: dict[str, BaseException] = {}
+        while True:
+            if not self.stopped.is_set():
+                for task in self.tasks.values():
+                    if task.name in started or task.function is None:
+                        continue
+                    if not all(dependency in self.timings for dependency in task.dependencies):
+                        continue
+                    started.add(task.name)
+                    running.add(task.name)
+                    Thread(target=self.run_task, args=(task, time(), slots), daemon=True).start()
+
+            if len(self.timings) == len(self.tasks) or (self.stopped.is_set() and len(running) == 0):
+                break
+
+            name, timing, result, error = self.finished.get()
+            running.discard(name)
+            if timing is None:
+                continue
+            if error is not None:
+                errors[name] = error
+                self.stopped.set()
+                continue
+            self.timings[name] = timing
+            self.results[name] = result
+
+        assert len(errors) == 0, (
+            f"{len(errors)} setup steps failed:\n"
+            + "\n".join(f"--- {name} ---\n{error}" for name, error in errors.items())
+        )
+
+    @beartype
+    def find_critical_path(self) -> list[str]:
+        """
+        Starts from the task which finished last and goes back through the dependency each task waited for last.
+        """
+
+        if len(self.timings) == 0:
+            return []
+        path = [max(self.timings, key=lambda name: self.timings[name].end_time)]
+        while len(self.tasks[path[-1]].dependencies) > 0:
+            path.append(
+                max(self.tasks[path[-1]].dependencies, key=lambda name: self.timings[name].end_time)
+            )
+        return path[::-1]
+
+    @beartype
+    def format_critical_path(self) -> str:
+        """
+        Each task on the critical path, with how long it ran and how long it waited for a free slot after its
+        dependencies were done.
+        """
+
+        path = self.find_critical_path()
+        if len(path) == 0:
+            return "NO SETUP STEPS RAN"
+        origin = min(timing.ready_time for timing in self.timings.values())
+        total_seconds = max(timing.end_time for timing in self.timings.values()) - origin
+        name_width = max(len(name) for name in path)
+        lines = [
+            f"=== CRITICAL PATH OF THE SETUP, {total_seconds:.1f}s IN TOTAL ===",
+            f"{'STEP':<{name_width}} {'START':>9} {'DURATION':>9} {'%':>6} {'SLOT WAIT':>10}",
+        ]
+        for name in path:
+            timing = self.timings[name]
+            lines.append(
+                f"{name:<{name_width}} {timing.start_time - origin:8.1f}s {timing.duration_seconds:8.1f}s"
+                + f" {100 * timing.duration_seconds / max(total_seconds, 1e-9):5.1f}% {timing.start_time - timing.ready_time:9.1f}s"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,148 @@
+import os
+import re
+import copy
+import secrets
+import yaml
+from dataclasses import dataclass
+from beartype import beartype
+
+import port_forward
+
+
+POD_TEMPLATE_FILENAME: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "ssh_pod_template.yaml"
+)
+# where the rendered manifest is written, since kubectl apply reads it from a file
+RENDERED_MANIFEST_FILENAME: str = os.path.join(port_forward.STATE_DIRECTORY, "pods.yaml")
+# the generated pod name prefix is kept, so that running setup.py again finds the same pods
+POD_NAME_PREFIX_FILENAME: str = os.path.join(port_forward.STATE_DIRECTORY, "pod_name_prefix")
+
+# for images built by build_image.py, which have sshd configured, instead of installing it every time the pod starts
+START_SSHD_COMMAND: list[str] = ["/bin/sh", "-c", "mkdir -p /run/sshd && exec /usr/sbin/sshd -D -e"]
+
+
+@beartype
+@dataclass(frozen=True)
+class PodTemplateParameters:
+    """
+    The fields which are None keep the value from the template.
+    """
+
+    image: str | None = None
+    namespace: str | None = None
+    # the sfcompute.com/tenant node selector
+    tenant: str | None = None
+    # the cpu request, and the cpu limit if `cpu_limit` is None
+    cpu: str | None = None
+    cpu_limit: str | None = None
+    memory: str | None = None
+    gpus_per_pod: int | None = None
+    # the size limit of the in-memory volume mounted on /dev/shm, which NCCL and the ray object store use
+    shm_size: str | None = None
+    # set for images built by build_image.py, see `START_SSHD_COMMAND`
+    image_has_sshd: bool = False
+
+
+@beartype
+def load_kubernetes_objects(config_filename: str) -> list[dict]:
+    with open(config_filename) as f:
+        return [object_ for object_ in yaml.safe_load_all(f) if object_ is not None]
+
+
+@beartype
+def get_pod_objects(objects: list[dict]) -> list[dict]:
+    """
+    The pods among the objects of a manifest, which can also have e.g. services or config maps.
+    """
+
+    return [object_ for object_ in objects if object_.get("kind") == "Pod"]
+
+
+@beartype
+def get_default_pod_name_prefix() -> str:
+    if os.path.exists(POD_NAME_PREFIX_FILENAME):
+        with open(POD_NAME_PREFIX_FILENAME) as f:
+            return f.read().strip()
+    prefix = f"ssh-pod-{secrets.token_hex(3)}"
+    os.makedirs(os.path.dirname(POD_NAME_PREFIX_FILENAME), exist_ok=True)
+    with open(POD_NAME_PREFIX_FILENAME, "w") as f:
+        f.write(prefix + "\n")
+    return prefix
+
+
+@beartype
+def get_pod_container(pod_object: dict) -> dict:
+    containers = pod_object["spec"]["containers"]
+    assert len(containers) == 1, "The pod template should have exactly one container."
+    return containers[0]
+
+
+@beartype
+def render_pod_manifests(
+    n_pods: int,
+    name_prefix: str,
+    parameters: PodTemplateParameters = PodTemplateParameters(),
+    template_filename: str = POD_TEMPLATE_FILENAME,
+) -> list[dict]:
+    """
+    One pod object per node, named `name_prefix`-0 to `name_prefix`-(n_pods - 1).
+    """
+
+    assert n_pods >= 1
+    # pod names must be valid DNS labels
+    assert re.fullmatch(r"[a-z0-9]([-a-z0-9]*[a-z0-9])?", name_prefix), (
+        f"Invalid pod name prefix {name_prefix!r}: it should only contain lowercase letters, digits and dashes."
+    )
+    assert len(f"{name_prefix}-{n_pods - 1}") <= 63, f"The pod name prefix {name_prefix!r} is too long."
+
+    template_objects = load_kubernetes_objects(template_filename)
+    assert len(template_objects) == 1, "The pod template should contain a single pod."
+    template = template_objects[0]
+
+    if parameters.namespace is not None:
+        template["metadata"]["namespace"] = parameters.namespace
+    if parameters.tenant is not None:
+        template["spec"].setdefault("nodeSelector", {})["sfcompute.com/tenant"] = parameters.tenant
+
+    container = get_pod_container(template)
+    if parameters.image is not None:
+        container["image"] = parameters.image
+    if parameters.image_has_sshd:
+        container["command"] = START_SSHD_COMMAND
+    resources = container.setdefault("resources", {})
+    requests = resources.setdefault("requests", {})
+    limits = resources.setdefault("limits", {})
+    if parameters.cpu is not None:
+        requests["cpu"] = parameters.cpu
+        limits["cpu"] = parameters.cpu_limit if parameters.cpu_limit is not None else parameters.cpu
+    elif parameters.cpu_limit is not None:
+        limits["cpu"] = parameters.cpu_limit
+    if parameters.memory is not None:
+        requests["memory"] = parameters.memory
+        limits["memory"] = parameters.memory
+    if parameters.gpus_per_pod is not None:
+        requests["nvidia.com/gpu"] = parameters.gpus_per_pod
+        limits["nvidia.com/gpu"] = parameters.gpus_per_pod
+    if parameters.shm_size is not None:
+        shm_volumes = [
+            volume
+            for volume in template["spec"].get("volumes", [])
+            if volume.get("emptyDir", {}).get("medium") == "Memory"
+        ]
+        assert len(shm_volumes) == 1, "The pod template should have exactly one in-memory volume for /dev/shm."
+        shm_volumes[0]["emptyDir"]["sizeLimit"] = parameters.shm_size
+
+    pod_objects: list[dict] = []
+    for i in range(n_pods):
+        pod_object = copy.deepcopy(template)
+        pod_object["metadata"]["name"] = f"{name_prefix}-{i}"
+        pod_objects.append(pod_object)
+    return pod_objects
+
+
+@beartype
+def write_kubernetes_objects(objects: list[dict], filename: str = RENDERED_MANIFEST_FILENAME) -> str:
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "w") as f:
+        yaml.safe_dump_all(objects, f, sort_keys=False)
+    return filename
@@ -0,0 +1,308 @@
+import socket
+import subprocess
+import os
+import sys
+import json
+import signal
+from argparse import ArgumentParser
+from datetime import datetime
+from threading import Event
+from time import sleep, monotonic, time
+from beartype import beartype
+
+
+STATE_DIRECTORY: str = ".sfcompute"
+SUPERVISOR_STATE_FILENAME: str = os.path.join(STATE_DIRECTORY, "port_forwards.json")
+SUPERVISOR_LOG_FILENAME: str = os.path.join(STATE_DIRECTORY, "port_forwards.log")
+# written to have the supervisor restart the dead port forwards immediately, see `retry_port_forwards`
+RETRY_FILENAME: str = os.path.join(STATE_DIRECTORY, "port_forwards.retry")
+
+FIRST_SSH_PORT: int = 2222
+
+# sockets bound to the ports we picked, so that nothing else takes them before the port forwards start
+reserved_port_sockets: dict[int, socket.socket] = {}
+
+
+@beartype
+def reserve_port(port: int) -> bool:
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(("127.0.0.1", port))
+    except OSError:
+        s.close()
+        return False
+    reserved_port_sockets[port] = s
+    return True
+
+
+@beartype
+def reserve_ports(how_many: int, first_port: int = FIRST_SSH_PORT) -> list[int]:
+    ports: list[int] = []
+    candidate_port = first_port
+    while len(ports) < how_many:
+        assert candidate_port < 65536, "Could not find enough free ports."
+        if reserve_port(candidate_port):
+            ports.append(candidate_port)
+        candidate_port += 1
+    return ports
+
+
+@beartype
+def release_port_reservations(ports: list[int]) -> None:
+    for port in ports:
+        s = reserved_port_sockets.pop(port, None)
+        if s is not None:
+            s.close()
+
+
+@beartype
+def ssh_banner_answers(port: int, timeout: float = 2.0) -> bool:
+    """
+    kubectl port-forward accepts local connections even when nothing listens in the pod,
+    so the port only counts as live once sshd's banner makes it through.
+    """
+
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=timeout) as s:
+            return s.recv(4).startswith(b"SSH-")
+    except OSError:
+        return False
+
+
+@beartype
+def wait_until_ssh_answers(
+    ports: list[int],
+    timeout_seconds: float = 600.0,
+    initial_backoff_seconds: float = 0.1,
+    max_backoff_seconds: float = 5.0,
+    stop: Event | None = None,
+) -> dict[int, float]:
+    """
+    Returns when sshd first answered on each port, in seconds since the epoch.
+    Returns early without the ports which did not answer if `stop` is set.
+    """
+
+    start_time = monotonic()
+    backoff_seconds = initial_backoff_seconds
+    pending_ports: set[int] = set(ports)
+    answer_times: dict[int, float] = {}
+    while True:
+        for port in list(pending_ports):
+            if ssh_banner_answers(port):
+                answer_times[port] = time()
+                pending_ports.remove(port)
+        if len(pending_ports) == 0 or (stop is not None and stop.is_set()):
+            break
+        assert monotonic() - start_time < timeout_seconds, (
+            f"sshd did not answer on ports {sorted(pending_ports)} after {timeout_seconds} seconds. See {SUPERVISOR_LOG_FILENAME}."
+        )
+        sleep(backoff_seconds)
+        backoff_seconds = min(2 * backoff_seconds, max_backoff_seconds)
+
+    if len(pending_ports) == 0:
+        print(
+            f"=== SSH IS REACHABLE ON PORTS {sorted(ports)} AFTER {monotonic() - start_time:.1f} SECONDS ===",
+            flush=True,
+        )
+    return answer_times
+
+
+@beartype
+def log(message: str) -> None:
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+
+@beartype
+def start_port_forward(pod_name: str, host_port: int, namespace: str | None = None) -> subprocess.Popen:
+    command = ["kubectl", "port-forward", f"pod/{pod_name}", f"{host_port}:22"]
+    if namespace is not None:
+        command += ["--namespace", namespace]
+    log(f"STARTING: {command}")
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL)
+
+
+@beartype
+def supervise_port_forwards(
+    pod_name_to_host_port: dict[str, int],
+    pod_name_to_namespace: dict[str, str | None] | None = None,
+    poll_interval_seconds: float = 1.0,
+    max_restart_backoff_seconds: float = 30.0,
+) -> None:
+    """
+    Starts one kubectl port-forward per pod and restarts any of them that dies, until SIGTERM.
+    The pods missing from `pod_name_to_namespace` are in the namespace of the current kubectl context.
+    A forward that keeps dying is restarted with exponential backoff, except when `retry_port_forwards` was called,
+    which restarts the dead forwards immediately.
+    """
+
+    def terminate(signal_number, frame) -> None:
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    processes: dict[str, subprocess.Popen] = {}
+    start_times: dict[str, float] = {}
+    consecutive_failures: dict[str, int] = {name: 0 for name in pod_name_to_host_port}
+    restart_at: dict[str, float] = {name: 0.0 for name in pod_name_to_host_port}
+    retry_time = get_retry_time()
+
+    try:
+        while True:
+            now = monotonic()
+            if get_retry_time() != retry_time:
+                retry_time = get_retry_time()
+                for pod_name in pod_name_to_host_port:
+                    consecutive_failures[pod_name] = 0
+                    restart_at[pod_name] = 0.0
+            for pod_name, host_port in pod_name_to_host_port.items():
+                process = processes.get(pod_name)
+
+                if process is not None and process.poll() is None:
+                    continue
+
+                if process is not None:
+                    log(
+                        f"PORT FORWARD FOR POD {pod_name} ON PORT {host_port} EXITED WITH CODE {process.returncode}"
+                    )
+                    del processes[pod_name]
+                    # a forward that stayed up for a while is not failing repeatedly
+                    if now - start_times[pod_name] > 60:
+                        consecutive_failures[pod_name] = 0
+                    backoff_seconds = min(
+                        0.5 * 2 ** consecutive_failures[pod_name],
+                        max_restart_backoff_seconds,
+                    )
+                    consecutive_failures[pod_name] += 1
+                    restart_at[pod_name] = now + backoff_seconds
+
+                if now >= restart_at[pod_name]:
+                    processes[pod_name] = start_port_forward(
+                        pod_name, host_port, (pod_name_to_namespace or {}).get(pod_name)
+                    )
+                    start_times[pod_name] = now
+
+            sleep(poll_interval_seconds)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+
+
+@beartype
+def process_is_alive(pid: int) -> bool:
+    # reap the process if it is our own child, otherwise it stays a zombie and looks alive
+    try:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    except ChildProcessError:
+        pass
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@beartype
+def get_retry_time() -> float | None:
+    return os.path.getmtime(RETRY_FILENAME) if os.path.exists(RETRY_FILENAME) else None
+
+
+@beartype
+def retry_port_forwards() -> None:
+    """
+    Has the supervisor restart the port forwards which are waiting to be restarted right away, e.g. because the pod
+    they forward to just became ready, while failed forwards are otherwise restarted with a backoff of up to 30 seconds.
+    """
+
+    os.makedirs(STATE_DIRECTORY, exist_ok=True)
+    with open(RETRY_FILENAME, "w") as f:
+        f.write(f"{time()}\n")
+
+
+@beartype
+def stop_port_forward_supervisor() -> None:
+    if not os.path.exists(SUPERVISOR_STATE_FILENAME):
+        return
+
+    with open(SUPERVISOR_STATE_FILENAME) as f:
+        pid: int = json.load(f)["pid"]
+
+    if process_is_alive(pid):
+        print(f"=== STOPPING PORT FORWARD SUPERVISOR WITH PID {pid} ===", flush=True)
+        os.kill(pid, signal.SIGTERM)
+        while process_is_alive(pid):
+            sleep(0.1)
+
+    os.remove(SUPERVISOR_STATE_FILENAME)
+
+
+@beartype
+def format_forward(pod_name: str, host_port: int, namespace: str | None) -> str:
+    """
+    A forward as the supervisor takes it on its command line, [<namespace>/]<pod name>=<host port>.
+    """
+
+    return f"{namespace + '/' if namespace is not None else ''}{pod_name}={host_port}"
+
+
+@beartype
+def launch_port_forward_supervisor(
+    pod_name_to_host_port: dict[str, int], pod_name_to_namespace: dict[str, str | None] | None = None
+) -> int:
+    """
+    Starts the supervisor as a detached process so that the port forwards keep being restarted after setup.py exits.
+    Stops the supervisor of any previous run first.
+    Returns the supervisor's pid.
+    """
+
+    stop_port_forward_supervisor()
+
+    os.makedirs(STATE_DIRECTORY, exist_ok=True)
+    release_port_reservations(list(pod_name_to_host_port.values()))
+    with open(SUPERVISOR_LOG_FILENAME, "a") as log_file:
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)]
+            + [
+                format_forward(name, port, (pod_name_to_namespace or {}).get(name))
+                for name, port in pod_name_to_host_port.items()
+            ],
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    with open(SUPERVISOR_STATE_FILENAME, "w") as f:
+        json.dump({"pid": process.pid, "ports": pod_name_to_host_port}, f)
+
+    print(
+        f"=== STARTED PORT FORWARD SUPERVISOR WITH PID {process.pid}, LOGGING TO {SUPERVISOR_LOG_FILENAME} ===",
+        flush=True,
+    )
+    return process.pid
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Keep kubectl port-forwards to the ssh port of pods alive."
+    )
+    parser.add_argument(
+        "forwards",
+        nargs="+",
+        help="[<namespace>/]<pod name>=<host port> for each pod, without a namespace for the current kubectl context's.",
+    )
+    args = parser.parse_args()
+
+    pod_name_to_host_port: dict[str, int] = {}
+    pod_name_to_namespace: dict[str, str | None] = {}
+    for forward in args.forwards:
+        pod, host_port = forward.rsplit("=", 1)
+        namespace, _, pod_name = pod.rpartition("/")
+        pod_name_to_host_port[pod_name] = int(host_port)
+        pod_name_to_namespace[pod_name] = namespace or None
+
+    supervise_port_forwards(pod_name_to_host_port, pod_name_to_namespace)
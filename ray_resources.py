@@ -0,0 +1,275 @@
+import re
+import json
+import math
+from shlex import quote
+from dataclasses import dataclass
+from beartype import beartype
+
+# resources of the pod spec which ray gets through its own options rather than as custom resources
+STANDARD_RESOURCES: set[str] = {"cpu", "memory", "nvidia.com/gpu", "ephemeral-storage"}
+# NCCL also keeps its intra-node buffers in /dev/shm, so the object store does not take all of it
+OBJECT_STORE_SHM_FRACTION: float = 0.8
+# ray's own default share of the memory for the object store
+OBJECT_STORE_MEMORY_FRACTION: float = 0.3
+# ray refuses to start with a smaller object store
+MIN_OBJECT_STORE_BYTES: int = 75 * 1024**2
+SPILL_SUBDIRECTORY: str = "ray_spill"
+SPILL_VOLUME_MOUNT_PATH: str = "/data"
+# the container of ssh_pod_template.yaml, which ray runs in when a pod also has sidecars
+RAY_CONTAINER_NAME: str = "cuda"
+
+QUANTITY_SUFFIXES: dict[str, float] = {
+    "": 1,
+    "m": 1e-3,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "P": 1e15,
+    "E": 1e18,
+    "Ki": 1024,
+    "Mi": 1024**2,
+    "Gi": 1024**3,
+    "Ti": 1024**4,
+    "Pi": 1024**5,
+    "Ei": 1024**6,
+}
+
+
+@beartype
+@dataclass(frozen=True)
+class RayResources:
+    """
+    What `ray start` is told about a pod. The fields which are None are left for ray to detect.
+    """
+
+    num_cpus: int | None
+    num_gpus: int
+    object_store_memory_bytes: int
+    # the memory ray schedules tasks and actors against
+    memory_bytes: int | None
+    # the limits the values above were derived from, for the logs
+    cpu_limit: float | None
+    memory_limit_bytes: int | None
+    shm_size_bytes: int | None
+    # None if the pod has no volume mounted on /data
+    spill_directory: str | None
+    custom_resources: dict[str, float]
+
+
+@beartype
+def parse_quantity(quantity: str | int | float) -> float:
+    """
+    A kubernetes quantity, e.g. 500m, 64Gi or 1e3.
+    """
+
+    if isinstance(quantity, (int, float)):
+        return float(quantity)
+    match = re.fullmatch(r"([+-]?[0-9.]+(?:[eE][+-]?[0-9]+)?)(Ki|Mi|Gi|Ti|Pi|Ei|m|k|M|G|T|P|E)?", quantity.strip())
+    assert match is not None, f"Invalid kubernetes quantity {quantity!r}."
+    return float(match.group(1)) * QUANTITY_SUFFIXES[match.group(2) or ""]
+
+
+@beartype
+def format_bytes(n_bytes: int | None) -> str:
+    return "-" if n_bytes is None else f"{n_bytes / 1024**3:.1f}Gi"
+
+
+@beartype
+def get_shm_size_bytes(pod_object: dict, container: dict) -> int | None:
+    """
+    The size limit of the in-memory volume mounted on /dev/shm, None if there is none or it has no size limit.
+    """
+
+    volume_names = [mount["name"] for mount in container.get("volumeMounts", []) if mount["mountPath"] == "/dev/shm"]
+    for volume in pod_object["spec"].get("volumes", []):
+        if volume["name"] in volume_names and volume.get("emptyDir", {}).get("medium") == "Memory":
+            size_limit = volume["emptyDir"].get("sizeLimit")
+            return int(parse_quantity(size_limit)) if size_limit is not None else None
+    return None
+
+
+@beartype
+def get_ray_container(pod_object: dict) -> dict:
+    """
+    The container ray runs in: the only container of the pod, else the one named `RAY_CONTAINER_NAME` as in the
+    pod template, else the first one requesting gpus. The resources of sidecars are not given to ray.
+    """
+
+    containers = pod_object["spec"]["containers"]
+    if len(containers) == 1:
+        return containers[0]
+
+    def requests_gpus(container: dict) -> bool:
+        resources = container.get("resources", {})
+        return "nvidia.com/gpu" in {**resources.get("requests", {}), **resources.get("limits", {})}
+
+    candidates = [container for container in containers if container["name"] == RAY_CONTAINER_NAME] + [
+        container for container in containers if requests_gpus(container)
+    ]
+    assert len(candidates) > 0, (
+        f"Pod {pod_object['metadata']['name']} has several containers, none of which is named {RAY_CONTAINER_NAME!r} or requests gpus, so it is not clear which one ray runs in."
+    )
+    return candidates[0]
+
+
+@beartype
+def get_ray_resources(pod_object: dict) -> RayResources:
+    """
+    Sizes ray from the spec of the pod's container (see `get_ray_container`), so that ray does not guess from the node it runs on:
+    the cpus from the cpu limit (the request if there is none), the object store from /dev/shm and the memory limit,
+    and extended resources (e.g. rdma/ib) as custom resources. Objects are spilled to /data if it is mounted.
+    """
+
+    name = pod_object["metadata"]["name"]
+    container = get_ray_container(pod_object)
+    requests = container.get("resources", {}).get("requests", {})
+    limits = container.get("resources", {}).get("limits", {})
+
+    def get(resource: str) -> float | None:
+        quantity = limits.get(resource, requests.get(resource))
+        return parse_quantity(quantity) if quantity is not None else None
+
+    cpu_limit = get("cpu")
+    memory_limit = get("memory")
+    memory_limit_bytes = int(memory_limit) if memory_limit is not None else None
+    shm_size_bytes = get_shm_size_bytes(pod_object, container)
+
+    object_store_limits = [
+        int(size * fraction)
+        for size, fraction in [(shm_size_bytes, OBJECT_STORE_SHM_FRACTION), (memory_limit_bytes, OBJECT_STORE_MEMORY_FRACTION)]
+        if size is not None
+    ]
+    assert len(object_store_limits) > 0, (
+        f"Pod {name} has neither a memory limit nor a size limit on /dev/shm, so the ray object store cannot be sized."
+    )
+    object_store_memory_bytes = min(object_store_limits)
+
+    memory_bytes: int | None = None
+    if memory_limit_bytes is not None:
+        # /dev/shm is in memory and counts towards the memory limit, so it is taken out whether the objects or NCCL fill it
+        memory_bytes = memory_limit_bytes - max(object_store_memory_bytes, shm_size_bytes or 0)
+
+    mount_paths = [mount["mountPath"].rstrip("/") for mount in container.get("volumeMounts", [])]
+    resources = RayResources(
+        num_cpus=math.floor(cpu_limit) if cpu_limit is not None else None,
+        num_gpus=int(get("nvidia.com/gpu") or 0),
+        object_store_memory_bytes=object_store_memory_bytes,
+        memory_bytes=memory_bytes,
+        cpu_limit=cpu_limit,
+        memory_limit_bytes=memory_limit_bytes,
+        shm_size_bytes=shm_size_bytes,
+        spill_directory=f"{SPILL_VOLUME_MOUNT_PATH}/{SPILL_SUBDIRECTORY}"
+        if SPILL_VOLUME_MOUNT_PATH in mount_paths
+        else None,
+        custom_resources={
+            resource: parse_quantity(quantity)
+            for resource, quantity in {**requests, **limits}.items()
+            if resource not in STANDARD_RESOURCES and not resource.startswith("hugepages-")
+        },
+    )
+    validate_ray_resources(name, resources)
+    return resources
+
+
+@beartype
+def validate_ray_resources(pod_name: str, resources: RayResources) -> None:
+    assert resources.num_cpus is None or resources.num_cpus >= 1, (
+        f"Pod {pod_name} has a cpu limit of {resources.cpu_limit}, ray needs at least one cpu."
+    )
+    assert resources.object_store_memory_bytes >= MIN_OBJECT_STORE_BYTES, (
+        f"Pod {pod_name} would get a ray object store of {format_bytes(resources.object_store_memory_bytes)}, ray needs at least {format_bytes(MIN_OBJECT_STORE_BYTES)}. Raise --shm-size or --pod-memory."
+    )
+    if resources.shm_size_bytes is not None:
+        assert resources.object_store_memory_bytes <= resources.shm_size_bytes, (
+            f"Pod {pod_name} would get a ray object store of {format_bytes(resources.object_store_memory_bytes)}, which does not fit in /dev/shm ({format_bytes(resources.shm_size_bytes)})."
+        )
+    if resources.memory_limit_bytes is not None:
+        assert resources.memory_bytes is not None and resources.memory_bytes > 0, (
+            f"Pod {pod_name} has a memory limit of {format_bytes(resources.memory_limit_bytes)}, which /dev/shm ({format_bytes(resources.shm_size_bytes)}) leaves nothing of. Raise --pod-memory or lower --shm-size."
+        )
+
+
+@beartype
+def get_ray_resources_by_pod(pod_objects: list[dict]) -> dict[str, RayResources]:
+    """
+    Also checks that the pods agree on where objects are spilled, since the head pod sets it for the whole cluster.
+    """
+
+    resources = {pod_object["metadata"]["name"]: get_ray_resources(pod_object) for pod_object in pod_objects}
+    spill_directories = {pod_resources.spill_directory for pod_resources in resources.values()}
+    assert len(spill_directories) == 1, (
+        f"Some pods have a volume mounted on {SPILL_VOLUME_MOUNT_PATH} and some do not, ray spills objects to the same directory on all of them."
+    )
+    return resources
+
+
+@beartype
+def get_ray_start_options(resources: RayResources, head: bool) -> str:
+    """
+    The options of `ray start`, quoted for the shell.
+    """
+
+    options = [
+        f"--num-gpus={resources.num_gpus}",
+        f"--object-store-memory={resources.object_store_memory_bytes}",
+    ]
+    if resources.num_cpus is not None:
+        options.append(f"--num-cpus={resources.num_cpus}")
+    if resources.memory_bytes is not None:
+        options.append(f"--memory={resources.memory_bytes}")
+    if len(resources.custom_resources) > 0:
+        options.append("--resources=" + quote(json.dumps(resources.custom_resources, sort_keys=True)))
+    # the spilling config is cluster wide and only the head takes it
+    if head and resources.spill_directory is not None:
+        spilling_config = {"type": "filesystem", "params": {"directory_path": resources.spill_directory}}
+        options.append(
+            "--system-config=" + quote(json.dumps({"object_spilling_config": json.dumps(spilling_config)}))
+        )
+    return " ".join(options)
+
+
+@beartype
+def get_shm_check_command(resources: RayResources) -> str:
+    """
+    Warns if /dev/shm on the pod is smaller than the object store, in which case ray falls back to a much slower
+    object store in /tmp. The spill directory is created, so that spilling does not fail on the first object.
+    """
+
+    command = (
+        f'shm_bytes=$(df --output=size -B1 /dev/shm | tail -n 1 | tr -d " "); '
+        f'if [ "$shm_bytes" -lt {resources.object_store_memory_bytes} ]; then '
+        f'echo "WARNING: /dev/shm has $shm_bytes bytes, less than the ray object store of {resources.object_store_memory_bytes} bytes"; fi'
+    )
+    if resources.spill_directory is not None:
+        command += f" && mkdir -p {resources.spill_directory}"
+    return command
+
+
+@beartype
+def format_ray_resources(resources: dict[str, RayResources]) -> str:
+    """
+    One line per distinct sizing, with the pods it applies to, since all pods are usually the same.
+    """
+
+    # RayResources is not hashable since it has a dict
+    groups: list[tuple[RayResources, list[str]]] = []
+    for pod_name, pod_resources in resources.items():
+        group = [pod_names for other, pod_names in groups if other == pod_resources]
+        if len(group) > 0:
+            group[0].append(pod_name)
+        else:
+            groups.append((pod_resources, [pod_name]))
+
+    lines = ["=== RAY RESOURCES SIZED FROM THE POD SPEC ==="]
+    for pod_resources, pod_names in groups:
+        lines.append(
+            f"{len(pod_names)} PODS ({pod_names[0]}{', ...' if len(pod_names) > 1 else ''}):"
+            + f" CPUS {pod_resources.num_cpus if pod_resources.num_cpus is not None else 'DETECTED BY RAY'} (LIMIT {pod_resources.cpu_limit}),"
+            + f" GPUS {pod_resources.num_gpus},"
+            + f" OBJECT STORE {format_bytes(pod_resources.object_store_memory_bytes)} (/dev/shm {format_bytes(pod_resources.shm_size_bytes)}),"
+            + f" MEMORY {format_bytes(pod_resources.memory_bytes)} (LIMIT {format_bytes(pod_resources.memory_limit_bytes)}),"
+            + f" SPILLING TO {pod_resources.spill_directory or 'RAY SESSION DIRECTORY'}"
+            + (f", CUSTOM RESOURCES {pod_resources.custom_resources}" if len(pod_resources.custom_resources) > 0 else "")
+        )
+    return "\n".join(lines)
@@ -0,0 +1,172 @@
+import os
+import re
+import json
+from shlex import quote
+from dataclasses import dataclass
+from beartype import beartype
+
+import port_forward
+
+
+# the key the pods use to ssh into the docker hosts, kept so that running setup.py again authorizes the same key
+SSH_KEY_FILENAME: str = os.path.join(port_forward.STATE_DIRECTORY, "docker_ssh_key")
+POD_SSH_KEY_FILENAME: str = "$HOME/.ssh/sfcompute_docker_ed25519"
+POD_CONTROL_SOCKETS_DIRECTORY: str = "$HOME/.ssh/sockets"
+
+# docker_balancer.py and the list of docker contexts it balances across, on the pods
+BALANCER_SOURCE_FILENAME: str = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "docker_balancer.py"
+)
+POD_BALANCER_DIRECTORY: str = "$HOME/.sfcompute/python"
+POD_HOSTS_CONFIG_FILENAME: str = "$HOME/.sfcompute/docker_hosts.json"
+
+# the ssh config of the docker hosts, which ~/.ssh/config on the pods includes
+POD_SSH_CONFIG_FILENAME: str = "$HOME/.sfcompute/docker_ssh_config"
+
+# sshd's default MaxSessions, which is what a host accepts if its ssh limits cannot be raised
+DEFAULT_MAX_SESSIONS: int = 10
+# docker opens one ssh session per operation, all multiplexed over one connection per pod and host,
+# so MaxSessions is how many operations a pod can run on a host at the same time
+RAISED_MAX_SESSIONS: int = 64
+SSH_LIMITS_RAISED_MARKER: str = "SSH LIMITS RAISED"
+
+
+@beartype
+@dataclass(frozen=True)
+class DockerHost:
+    username_at_address: str
+
+    @property
+    def address(self) -> str:
+        return self.username_at_address.split("@")[-1]
+
+    @property
+    def context(self) -> str:
+        return "sfcompute-" + re.sub(r"[^a-zA-Z0-9_.-]", "-", self.username_at_address)
+
+    @property
+    def url(self) -> str:
+        return f"ssh://{self.username_at_address}"
+
+
+@beartype
+def parse_docker_hosts(usernames_at_addresses: list[str]) -> list[DockerHost]:
+    for username_at_address in usernames_at_addresses:
+        assert re.fullmatch(r"[A-Za-z0-9_.-]+@[A-Za-z0-9_.:-]+", username_at_address), (
+            f"Invalid docker host {username_at_address!r}, it should be <username>@<address>."
+        )
+    hosts = [DockerHost(username_at_address) for username_at_address in usernames_at_addresses]
+    assert len({host.context for host in hosts}) == len(hosts), "The docker hosts should be distinct."
+    return hosts
+
+
+@beartype
+def get_raise_ssh_limits_command(max_sessions: int = RAISED_MAX_SESSIONS) -> str:
+    """
+    Raises MaxSessions and MaxStartups on a docker host and reloads sshd, which keeps the open connections.
+    sshd uses the first value it reads for each option, so if sshd_config includes sshd_config.d the values go in a
+    drop-in read before the others, and otherwise they replace the global ones in sshd_config, before its first
+    Match block since MaxStartups is not allowed in one.
+    The new config is checked with `sshd -t` before it is moved into place, so a config sshd rejects is never left
+    behind for the next restart of sshd to fail on.
+    Prints `SSH_LIMITS_RAISED_MARKER` on success, and nothing if the user cannot sudo without a password.
+    """
+
+    options = f"MaxSessions {max_sessions}\\nMaxStartups {max_sessions}:30:{4 * max_sessions}"
+    script = f"""
+sudo -n true 2>/dev/null || exit 0
+set -e
+config=/etc/ssh/sshd_config
+new=$(mktemp)
+check=$(mktemp)
+trap 'rm -f "$new" "$check"' EXIT
+if grep -q '^Include /etc/ssh/sshd_config.d/' "$config"; then
+    target=/etc/ssh/sshd_config.d/00-sfcompute.conf
+    printf '{options}\\n' > "$new"
+    # sshd_config with the new drop-in included where sshd_config.d is
+    sudo -n cat "$config" | sed "s#^Include /etc/ssh/sshd_config.d/#Include $new\\n&#" > "$check"
+else
+    target="$config"
+    sudo -n cat "$config" | awk -v options='{options}' '
+        !done && /^[[:space:]]*[Mm]atch[[:space:]]/ {{ print options; done = 1 }}
+        !done && /^[[:space:]]*(MaxSessions|MaxStartups)[[:space:]]/ {{ next }}
+        {{ print }}
+        END {{ if (!done) print options }}' > "$new"
+    cp "$new" "$check"
+fi
+sudo -n sshd -t -f "$check"
+sudo -n install -m 644 "$new" "$target.sfcompute-new"
+sudo -n mv "$target.sfcompute-new" "$target"
+sudo -n systemctl reload ssh 2>/dev/null || sudo -n systemctl reload sshd 2>/dev/null || sudo -n kill -HUP $(cat /var/run/sshd.pid)
+echo {SSH_LIMITS_RAISED_MARKER}
+"""
+    return f"sh -c {quote(script)}"
+
+
+@beartype
+def get_ssh_config(hosts: list[DockerHost]) -> str:
+    """
+    One connection per pod and host is kept open and every docker operation is a session multiplexed over it,
+    so that parallel operations do not each pay for a new ssh handshake or count against the host's MaxStartups.
+    """
+
+    lines: list[str] = []
+    for host in hosts:
+        lines += [
+            f"Host {host.address}",
+            f"    IdentityFile {POD_SSH_KEY_FILENAME.replace('$HOME', '~')}",
+            "    StrictHostKeyChecking accept-new",
+            "    ControlMaster auto",
+            f"    ControlPath {POD_CONTROL_SOCKETS_DIRECTORY.replace('$HOME', '~')}/%C",
+            "    ControlPersist 10m",
+            "    ServerAliveInterval 30",
+        ]
+    # so that nothing after the include is restricted to the last host
+    lines.append("Host *")
+    return "\n".join(lines) + "\n"
+
+
+@beartype
+def get_include_ssh_config_command() -> str:
+    """
+    ssh uses the first value it reads for each option, and an Include after a Host line only applies to that host,
+    so the Include goes at the start of ~/.ssh/config.
+    """
+
+    include_line = f"Include {POD_SSH_CONFIG_FILENAME.replace('$HOME', '~')}"
+    return (
+        f'mkdir -p "{POD_CONTROL_SOCKETS_DIRECTORY}" && chmod 700 "$HOME/.ssh"'
+        + f" && (grep -qxF '{include_line}' \"$HOME/.ssh/config\" 2>/dev/null"
+        + f" || {{ {{ echo '{include_line}'; cat \"$HOME/.ssh/config\" 2>/dev/null; }} > /tmp/sfcompute_ssh_config"
+        + ' && mv /tmp/sfcompute_ssh_config "$HOME/.ssh/config" && chmod 600 "$HOME/.ssh/config"; })'
+    )
+
+
+@beartype
+def get_hosts_config(hosts: list[DockerHost], max_sessions: dict[DockerHost, int]) -> str:
+    """
+    The content of `POD_HOSTS_CONFIG_FILENAME`, which docker_balancer.py reads.
+    """
+
+    return json.dumps(
+        {
+            "hosts": [
+                {"context": host.context, "url": host.url, "slots": max_sessions[host]}
+                for host in hosts
+            ]
+        },
+        indent=2,
+    )
+
+
+@beartype
+def get_write_contexts_command(hosts: list[DockerHost]) -> str:
+    """
+    Recreates one docker context per host and makes the first one the default, so that plain `docker` keeps working.
+    """
+
+    commands = [
+        f"docker context rm -f {host.context} > /dev/null 2>&1; docker context create {host.context} --docker host={host.url} > /dev/null"
+        for host in hosts
+    ]
+    return " && ".join(commands + [f"docker context use {hosts[0].context}"])
@@ -0,0 +1,198 @@
+import re
+from dataclasses import dataclass
+from beartype import beartype
+
+
+STEP_MARKER: str = "@@SFCOMPUTE_STEP"
+
+# the script is sent over stdin so that secrets in it never end up in argv or on the pod's disk
+REMOTE_SCRIPT_COMMAND: str = "bash -s 2>&1"
+
+# one file per completed step, containing the fingerprint of the step's inputs
+JOURNAL_DIRECTORY: str = "$HOME/.sfcompute/journal"
+
+
+@beartype
+@dataclass(frozen=True)
+class ScriptStep:
+    name: str
+    command: str
+    # if not None, the step is skipped when the pod's journal says it already completed with the same fingerprint
+    # it is evaluated by bash inside double quotes, so it can contain $(...) to fingerprint the state of the pod
+    # it is evaluated before the step to decide whether to skip it and again after it to record it in the journal
+    fingerprint: str | None = None
+
+
+@beartype
+@dataclass(frozen=True)
+class StepResult:
+    name: str
+    started: bool
+    # None if the step did not finish, e.g. because the ssh connection dropped
+    exit_code: int | None
+    duration_seconds: float | None
+    skipped: bool = False
+    # seconds since the epoch on the pod's clock, None if the step did not start
+    start_time: float | None = None
+    # what is recorded in the pod's journal for this step, if the step is journaled and completed
+    fingerprint: str | None = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.skipped or self.exit_code == 0
+
+    @property
+    def status(self) -> str:
+        if self.skipped:
+            return "ALREADY DONE"
+        if self.exit_code is None:
+            return "NOT FINISHED" if self.started else "NOT STARTED"
+        if self.exit_code == 0:
+            return "OK"
+        return f"FAILED WITH EXIT CODE {self.exit_code}"
+
+
+@beartype
+def build_script(steps: list[ScriptStep], resume: bool = True) -> str:
+    """
+    Builds a single bash script running the steps in order and stopping at the first failing one.
+    Each step runs in its own subshell and prints start and end markers with timestamps to stdout,
+    which `parse_step_results` turns back into one result per step.
+
+    With `resume`, steps with a fingerprint are skipped if the journal says they completed with the same fingerprint.
+    Once a step with a fingerprint runs, all the following ones run too, since they might depend on it.
+    """
+
+    step_names = [step.name for step in steps]
+    assert len(set(step_names)) == len(step_names), "Step names must be unique."
+    for name in step_names:
+        assert re.fullmatch(r"[A-Za-z0-9_.-]+", name), f"Invalid step name {name!r}."
+
+    lines: list[str] = [
+        "#!/bin/bash",
+        f'mkdir -p "{JOURNAL_DIRECTORY}"',
+        f"sfcompute_force={0 if resume else 1}",
+    ]
+    for step in steps:
+        run_step_lines: list[str] = [
+            f'echo "{STEP_MARKER} START {step.name} $(date +%s.%N)"',
+            "(",
+            step.command,
+            ")",
+            "sfcompute_exit_code=$?",
+            f'echo "{STEP_MARKER} END {step.name} $sfcompute_exit_code $(date +%s.%N)"',
+            '[ "$sfcompute_exit_code" -eq 0 ] || exit "$sfcompute_exit_code"',
+        ]
+
+        if step.fingerprint is None:
+            lines += run_step_lines
+            continue
+
+        journal_filename = f"{JOURNAL_DIRECTORY}/{step.name}"
+        lines += [
+            f'sfcompute_fingerprint="{step.fingerprint}"',
+            f'if [ "$sfcompute_force" = 0 ] && [ -f "{journal_filename}" ] && [ "$(cat "{journal_filename}")" = "$sfcompute_fingerprint" ]; then',
+            f'echo "{STEP_MARKER} SKIP {step.name} $sfcompute_fingerprint"',
+            "else",
+            f'rm -f "{journal_filename}"',
+            *run_step_lines,
+            "sfcompute_force=1",
+            f'sfcompute_fingerprint="{step.fingerprint}"',
+            f'echo "$sfcompute_fingerprint" > "{journal_filename}"',
+            f'echo "{STEP_MARKER} JOURNAL {step.name} $sfcompute_fingerprint"',
+            "fi",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+@beartype
+def parse_step_results(output: str, steps: list[ScriptStep]) -> list[StepResult]:
+    start_times: dict[str, float] = {}
+    end_times: dict[str, float] = {}
+    exit_codes: dict[str, int] = {}
+    skipped: set[str] = set()
+    fingerprints: dict[str, str] = {}
+    for line in output.splitlines():
+        # the previous output of the step might not end with a newline
+        if STEP_MARKER not in line:
+            continue
+        fields = line[line.index(STEP_MARKER) :].split(" ")
+        if fields[1] == "START" and len(fields) == 4:
+            start_times[fields[2]] = float(fields[3])
+        if fields[1] == "END" and len(fields) == 5:
+            exit_codes[fields[2]] = int(fields[3])
+            end_times[fields[2]] = float(fields[4])
+        if fields[1] in ["SKIP", "JOURNAL"] and len(fields) >= 3:
+            fingerprints[fields[2]] = " ".join(fields[3:])
+            if fields[1] == "SKIP":
+                skipped.add(fields[2])
+
+    results: list[StepResult] = []
+    for step in steps:
+        if step.name in skipped:
+            results.append(
+                StepResult(
+                    name=step.name,
+                    started=False,
+                    exit_code=None,
+                    duration_seconds=None,
+                    skipped=True,
+                    fingerprint=fingerprints[step.name],
+                )
+            )
+        elif step.name not in end_times:
+            results.append(
+                StepResult(
+                    name=step.name,
+                    started=step.name in start_times,
+                    exit_code=None,
+                    duration_seconds=None,
+                    start_time=start_times.get(step.name),
+                )
+            )
+        else:
+            results.append(
+                StepResult(
+                    name=step.name,
+                    started=True,
+                    exit_code=exit_codes[step.name],
+                    duration_seconds=end_times[step.name] - start_times[step.name],
+                    start_time=start_times[step.name],
+                    fingerprint=fingerprints.get(step.name),
+                )
+            )
+    return results
+
+
+@beartype
+def describe_step_marker(line: str) -> str:
+    fields = line[line.index(STEP_MARKER) :].split(" ")
+    if fields[1] == "START":
+        return f"STARTED STEP {fields[2]}"
+    if fields[1] == "SKIP":
+        return f"SKIPPED STEP {fields[2]} BECAUSE IT IS ALREADY DONE"
+    if fields[1] == "JOURNAL":
+        return f"RECORDED STEP {fields[2]} AS DONE"
+    return f"FINISHED STEP {fields[2]} WITH EXIT CODE {fields[3]}"
+
+
+@beartype
+def strip_step_markers(output: str) -> str:
+    return "".join(
+        line[: line.index(STEP_MARKER)] if STEP_MARKER in line else line
+        for line in output.splitlines(keepends=True)
+    )
+
+
+@beartype
+def format_step_results(results: list[StepResult]) -> str:
+    name_width = max([len(result.name) for result in results] + [4])
+    lines: list[str] = []
+    for result in results:
+        duration = (
+            f"{result.duration_seconds:8.1f}s"
+            if result.duration_seconds is not None
+            else " " * 9
+        )
+        lines.append(f"{result.name:<{name_width}} {duration} {result.status}")
+    return "\n".join(lines)
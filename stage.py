@@ -0,0 +1,385 @@
+import os
+import sys
+import json
+import hashlib
+import subprocess
+from shlex import quote
+from argparse import ArgumentParser
+from dataclasses import dataclass
+from time import monotonic, time
+from beartype import beartype
+
+import stage_agent
+import setup
+from setup import Pod
+
+
+STAGE_AGENT_FILENAME: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stage_agent.py")
+POD_STAGE_AGENT_FILENAME: str = "/tmp/sfcompute_stage_agent.py"
+POD_MANIFEST_FILENAME: str = "/tmp/sfcompute_stage_manifest.json"
+STAGE_PORT: int = 29556
+
+# /data is the pods' emptyDir on disk, /dev/shm is in memory and counts against the pod's memory
+DESTINATIONS: dict[str, str] = {"data": "/data", "shm": "/dev/shm"}
+
+DEFAULT_CHUNK_MEGABYTES: int = 16
+DEFAULT_STREAMS: int = 4
+DEFAULT_TIMEOUT_SECONDS: float = 3600.0
+
+
+@beartype
+@dataclass(frozen=True)
+class RelayResult:
+    node: str
+    parent: str | None
+    received_bytes: int
+    resumed_bytes: int
+    total_bytes: int
+    pull_seconds: float
+    gbps: float
+    finish_time: float
+    children_finished: bool
+
+
+@beartype
+def get_staging_directory(destination: str, name: str) -> str:
+    assert destination in DESTINATIONS, f"The destination should be one of {list(DESTINATIONS)}."
+    assert "/" not in name and name not in ["", ".", ".."], f"Invalid name {name!r}."
+    return f"{DESTINATIONS[destination]}/staging/{name}"
+
+
+@beartype
+def get_default_name(source: str) -> str:
+    """
+    The name of the source file or directory. URLs also get a hash of the whole URL, so that two URLs ending in the
+    same file name are not staged in the same directory, where the second download would resume the first one's file.
+    """
+
+    name = os.path.basename(source.rstrip("/").split("?")[0])
+    if source.startswith("http://") or source.startswith("https://"):
+        name += "-" + hashlib.sha256(source.encode()).hexdigest()[:8]
+    return name
+
+
+@beartype
+def get_broadcast_parents(n_nodes: int, fanout: int) -> list[int | None]:
+    """
+    Node 0 has the artifacts and node i gets them from node (i - 1) // fanout.
+    With a fanout of 1 the nodes form a pipeline, where every node forwards each chunk as soon as it has it,
+    so the total time barely grows with the number of nodes as long as the files are much bigger than a chunk.
+    """
+
+    assert fanout >= 1
+    return [None] + [(i - 1) // fanout for i in range(1, n_nodes)]
+
+
+@beartype
+def get_relay_arguments(
+    root: str,
+    manifest_filename: str,
+    port: int,
+    parent_address: str | None,
+    n_children: int,
+    n_streams: int,
+    timeout_seconds: float,
+) -> list[str]:
+    return [
+        "relay",
+        root,
+        manifest_filename,
+        str(port),
+        parent_address if parent_address is not None else "-",
+        str(n_children),
+        str(n_streams),
+        str(timeout_seconds),
+    ]
+
+
+@beartype
+def parse_relay_result(output: str, node: str, parent: str | None) -> RelayResult:
+    results = [
+        json.loads(line.removeprefix(stage_agent.RESULT_PREFIX))
+        for line in output.splitlines()
+        if line.startswith(stage_agent.RESULT_PREFIX)
+    ]
+    assert len(results) == 1, f"Could not parse the result of the relay on {node} from:\n{output[-2048:]}"
+    return RelayResult(node=node, parent=parent, **results[0])
+
+
+@beartype
+def format_report(results: list[RelayResult], start_time: float) -> str:
+    """
+    The throughput of each link and how long the artifacts took to reach the first k nodes, for every k.
+    `start_time` is when the broadcast started, as seconds since the epoch.
+    """
+
+    name_width = max([len(result.node) for result in results] + [4])
+    lines: list[str] = [
+        f"{'FROM':<{name_width}} {'TO':<{name_width}} {'RECEIVED':>10} {'RESUMED':>10} {'SECONDS':>8} {'THROUGHPUT':>12}"
+    ]
+    for result in results:
+        if result.parent is None:
+            continue
+        lines.append(
+            f"{result.parent:<{name_width}} {result.node:<{name_width}} {result.received_bytes / 1e9:8.2f}GB {result.resumed_bytes / 1e9:8.2f}GB {result.pull_seconds:8.1f} {result.gbps:7.2f} Gb/s"
+        )
+    lines.append("=== TIME TO REACH N NODES ===")
+    for i, result in enumerate(sorted(results, key=lambda result: result.finish_time)):
+        lines.append(f"{i + 1:>4} NODES: {max(0.0, result.finish_time - start_time):8.1f}s ({result.node})")
+    return "\n".join(lines)
+
+
+@beartype
+def check_results(results: list[RelayResult]) -> None:
+    unfinished = [result.node for result in results if not result.children_finished]
+    assert len(unfinished) == 0, (
+        f"The children of {', '.join(unfinished)} did not finish before the timeout. Running stage.py again resumes the transfer."
+    )
+
+
+@beartype
+def finish(results: list[RelayResult], start_time: float) -> list[RelayResult]:
+    print("=== STAGING THROUGHPUT ===")
+    print(format_report(results, start_time))
+    check_results(results)
+    print(f"=== STAGED ON {len(results)} NODES IN {max(result.finish_time for result in results) - start_time:.1f}s ===")
+    return results
+
+
+@beartype
+def list_files(directory: str) -> set[tuple[str, int]]:
+    return {
+        (os.path.relpath(os.path.join(parent, filename), directory), os.path.getsize(os.path.join(parent, filename)))
+        for parent, subdirectories, filenames in os.walk(directory)
+        if stage_agent.STATE_DIRECTORY not in os.path.relpath(parent, directory).split(os.sep)
+        for filename in filenames
+    }
+
+
+@beartype
+def fetch_to_head_pod(head_pod: Pod, source: str, root: str) -> None:
+    """
+    URLs are downloaded by the head pod, resuming a partial download. Local files and directories are uploaded,
+    unless the head pod already has files with the same names and sizes.
+    """
+
+    if source.startswith("http://") or source.startswith("https://"):
+        filename = quote(source.rstrip("/").split("/")[-1].split("?")[0])
+        setup.ssh_run_command(
+            head_pod,
+            f"mkdir -p {root} && cd {root} && curl -fL --retry 5 -C - -o {filename} {quote(source)}",
+            truncate_output_to_length=2048,
+        )
+        return
+
+    assert os.path.exists(source), f"{source} does not exist."
+    if os.path.isdir(source):
+        local_files = list_files(source)
+    else:
+        local_files = {(os.path.basename(source), os.path.getsize(source))}
+    output: str = setup.run_command(
+        setup.get_remote_command(
+            head_pod,
+            f"cd {root} 2>/dev/null && find . -path ./{stage_agent.STATE_DIRECTORY} -prune -o -type f -printf '%P %s\\n'",
+        ),
+        check=False,
+        verbose=False,
+    )  # type: ignore
+    remote_files = {
+        (line.rsplit(" ", 1)[0], int(line.rsplit(" ", 1)[1])) for line in output.splitlines() if " " in line
+    }
+    if local_files <= remote_files:
+        print(f"=== {head_pod.name} ALREADY HAS {source} ===")
+        return
+    setup.push_files(
+        [head_pod],
+        {source: root if os.path.isdir(source) else f"{root}/{os.path.basename(source)}"},
+    )
+
+
+@beartype
+def stage_on_pods(
+    pods: list[Pod],
+    source: str,
+    destination: str,
+    name: str,
+    fanout: int = 1,
+    chunk_megabytes: int = DEFAULT_CHUNK_MEGABYTES,
+    n_streams: int = DEFAULT_STREAMS,
+    timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+    max_concurrency: int = setup.DEFAULT_MAX_CONCURRENCY,
+) -> list[RelayResult]:
+    """
+    Gets `source` onto the head pod once, then broadcasts it to the other pods over the pod network.
+    """
+
+    root = get_staging_directory(destination, name)
+    head_pod = pods[0]
+
+    print(f"=== GETTING {source} ONTO {head_pod.name} IN {root} ===", flush=True)
+    fetch_start_time = monotonic()
+    fetch_to_head_pod(head_pod, source, root)
+    print(f"=== {source} IS ON {head_pod.name} AFTER {monotonic() - fetch_start_time:.1f}s ===", flush=True)
+
+    setup.push_files(pods, {STAGE_AGENT_FILENAME: POD_STAGE_AGENT_FILENAME}, max_concurrency=max_concurrency)
+    manifest: str = setup.run_command(
+        setup.get_remote_command(
+            head_pod, f"python3 {POD_STAGE_AGENT_FILENAME} manifest {root} {chunk_megabytes * 1024 * 1024}"
+        ),
+        verbose=False,
+    )  # type: ignore
+    manifest_object = json.loads(manifest)
+    total_bytes = sum(file["size"] for file in manifest_object["files"])
+    setup.push_files(pods, {manifest.encode(): POD_MANIFEST_FILENAME}, max_concurrency=max_concurrency)
+
+    pod_ips = setup.map_on_all(pods, setup.get_pod_ip, max_concurrency=max_concurrency)
+    parents = get_broadcast_parents(len(pods), fanout)
+    n_children = [parents.count(i) for i in range(len(pods))]
+    print(
+        f"=== BROADCASTING {total_bytes / 1e9:.2f}GB IN {len(manifest_object['files'])} FILES TO {len(pods) - 1} PODS WITH A FANOUT OF {fanout} ===",
+        flush=True,
+    )
+
+    start_time = time()
+    outputs = setup.map_on_all(
+        pods,
+        lambda pod: setup.ssh_run_command(
+            pod,
+            " ".join(
+                ["python3", POD_STAGE_AGENT_FILENAME]
+                + get_relay_arguments(
+                    root,
+                    POD_MANIFEST_FILENAME,
+                    port=STAGE_PORT,
+                    parent_address=f"{pod_ips[pods[parents[pods.index(pod)]]]}:{STAGE_PORT}"
+                    if parents[pods.index(pod)] is not None
+                    else None,
+                    n_children=n_children[pods.index(pod)],
+                    n_streams=n_streams,
+                    timeout_seconds=timeout_seconds,
+                )
+            ),
+            truncate_output_to_length=4096,
+        ),
+        # every relay has to run at the same time, since the children pull from their parents
+        max_concurrency=len(pods),
+    )
+    results = [
+        parse_relay_result(
+            outputs[pod], node=pod.name, parent=pods[parents[i]].name if parents[i] is not None else None
+        )
+        for i, pod in enumerate(pods)
+    ]
+    return finish(results, start_time)
+
+
+@beartype
+def stage_locally(
+    source: str,
+    destinations: list[str],
+    fanout: int = 1,
+    chunk_megabytes: int = DEFAULT_CHUNK_MEGABYTES,
+    n_streams: int = DEFAULT_STREAMS,
+    timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+    first_port: int = STAGE_PORT,
+) -> list[RelayResult]:
+    """
+    The same broadcast as `stage_on_pods`, where `source` plays the head pod and each destination directory
+    plays a worker pod, with the relays running as local processes talking over localhost.
+    """
+
+    assert os.path.isdir(source), f"{source} is not a directory."
+    manifest = json.dumps(stage_agent.get_manifest(source, chunk_megabytes * 1024 * 1024))
+    nodes = [source] + destinations
+    parents = get_broadcast_parents(len(nodes), fanout)
+    manifest_filename = os.path.join(source, stage_agent.STATE_DIRECTORY, "manifest.json")
+    os.makedirs(os.path.dirname(manifest_filename), exist_ok=True)
+    with open(manifest_filename, "w") as f:
+        f.write(manifest)
+
+    start_time = time()
+    processes = [
+        subprocess.Popen(
+            [sys.executable, STAGE_AGENT_FILENAME]
+            + get_relay_arguments(
+                node,
+                manifest_filename,
+                port=first_port + i,
+                parent_address=f"127.0.0.1:{first_port + parents[i]}" if parents[i] is not None else None,
+                n_children=parents.count(i),
+                n_streams=n_streams,
+                timeout_seconds=timeout_seconds,
+            ),
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for i, node in enumerate(nodes)
+    ]
+    outputs = [process.communicate()[0] for process in processes]
+    results = [
+        parse_relay_result(output, node=node, parent=nodes[parents[i]] if parents[i] is not None else None)
+        for i, (node, output) in enumerate(zip(nodes, outputs, strict=True))
+    ]
+    for destination in destinations:
+        assert list_files(destination) == list_files(source), f"{destination} differs from {source}."
+    return finish(results, start_time)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Get model weights or datasets onto the head pod once, then broadcast them to all the pods of the cluster set up by setup.py over the pod network, in chunks which are checksummed and resumed if the transfer is interrupted."
+    )
+    parser.add_argument("source", type=str, help="A local file or directory, or an http(s) URL which the head pod downloads.")
+    parser.add_argument(
+        "--destination",
+        choices=list(DESTINATIONS),
+        default="data",
+        help="'data': the /data volume. 'shm': /dev/shm, which is in memory. The files go in <destination>/staging/<name>.",
+    )
+    parser.add_argument(
+        "--name",
+        type=str,
+        help="The directory the files go in: <destination>/staging/<name>/ gets the contents of a source directory, or a single source file (or download) under its own name, e.g. /data/staging/<name>/model.safetensors. Defaults to the name of the source, followed by a hash of the URL for URLs.",
+    )
+    parser.add_argument(
+        "--fanout",
+        type=int,
+        default=1,
+        help="How many pods each pod forwards the chunks to. 1 makes a pipeline through all the pods, more makes a tree.",
+    )
+    parser.add_argument("--chunk-megabytes", type=int, default=DEFAULT_CHUNK_MEGABYTES)
+    parser.add_argument("--streams", type=int, default=DEFAULT_STREAMS, help="Connections each pod pulls chunks over.")
+    parser.add_argument("--timeout-seconds", type=float, default=DEFAULT_TIMEOUT_SECONDS)
+    parser.add_argument("--max-concurrency", type=int, default=setup.DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument(
+        "--local",
+        type=str,
+        nargs="+",
+        metavar="DIRECTORY",
+        help="Instead of the pods, broadcast the source directory to these local directories, for testing.",
+    )
+    args = parser.parse_args()
+
+    if args.local is not None:
+        stage_locally(
+            args.source,
+            args.local,
+            fanout=args.fanout,
+            chunk_megabytes=args.chunk_megabytes,
+            n_streams=args.streams,
+            timeout_seconds=args.timeout_seconds,
+        )
+    else:
+        pods = setup.get_pods_from_port_forwards()
+        setup.open_ssh_control_connections(pods, max_concurrency=args.max_concurrency)
+        stage_on_pods(
+            pods,
+            source=args.source,
+            destination=args.destination,
+            name=args.name if args.name is not None else get_default_name(args.source),
+            fanout=args.fanout,
+            chunk_megabytes=args.chunk_megabytes,
+            n_streams=args.streams,
+            timeout_seconds=args.timeout_seconds,
+            max_concurrency=args.max_concurrency,
+        )
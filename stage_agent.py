@@ -0,0 +1,293 @@
+"""
+Runs on every pod during `stage.py`, with the pods' system python and only the standard library.
+It also runs locally, with directories standing in for pods, see `stage.py --local`.
+
+manifest <root> <chunk bytes>
+    Prints the manifest of the files under <root>: their sizes, modes and the sha256 of each chunk.
+relay <root> <manifest file> <port> <parent address or -> <number of children> <streams> <timeout seconds>
+    Serves the chunks of <root> to the children as soon as it has them, and pulls the missing ones from the parent
+    over <streams> connections, checking each against the manifest. Without a parent, <root> has all the chunks.
+    Exits once it has all the chunks and all the children said they have them too.
+
+The chunks a node has are appended to a journal in <root>, so that a relay which is restarted only pulls the
+chunks it is missing.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import hashlib
+import threading
+
+RESULT_PREFIX = "STAGE RESULT: "
+STATE_DIRECTORY = ".sfcompute-stage"
+CONNECT_RETRY_SECONDS = 60.0
+MAX_CHUNK_ATTEMPTS = 3
+
+
+def get_manifest(root, chunk_bytes):
+    files = []
+    directories = []
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories[:] = sorted(name for name in subdirectories if name != STATE_DIRECTORY)
+        relative_directory = os.path.relpath(directory, root)
+        if relative_directory != ".":
+            directories.append(relative_directory)
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            chunks = []
+            with open(path, "rb") as f:
+                while data := f.read(chunk_bytes):
+                    chunks.append(hashlib.sha256(data).hexdigest())
+            files.append(
+                {
+                    "path": os.path.relpath(path, root),
+                    "size": os.path.getsize(path),
+                    "mode": os.stat(path).st_mode & 0o777,
+                    "chunks": chunks,
+                }
+            )
+    return {"chunk_bytes": chunk_bytes, "directories": directories, "files": files}
+
+
+def get_manifest_id(manifest):
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def receive_exactly(connection, n_bytes):
+    parts = []
+    while n_bytes > 0:
+        part = connection.recv(min(n_bytes, 1 << 20))
+        if not part:
+            raise ConnectionError("The connection was closed.")
+        parts.append(part)
+        n_bytes -= len(part)
+    return b"".join(parts)
+
+
+def receive_line(connection):
+    line = b""
+    while not line.endswith(b"\n"):
+        byte = connection.recv(1)
+        if not byte:
+            return None
+        line += byte
+    return line.decode().strip()
+
+
+class Relay:
+    def __init__(self, root, manifest, n_children):
+        self.root = root
+        self.manifest = manifest
+        self.chunk_bytes = manifest["chunk_bytes"]
+        self.n_children = n_children
+        self.done = set()
+        self.children_done = 0
+        self.condition = threading.Condition()
+        self.state_directory = os.path.join(root, STATE_DIRECTORY)
+        os.makedirs(self.state_directory, exist_ok=True)
+        self.journal_filename = os.path.join(self.state_directory, f"done-{get_manifest_id(manifest)}")
+        self.complete_filename = os.path.join(self.state_directory, f"complete-{get_manifest_id(manifest)}")
+
+    def all_chunks(self):
+        return [
+            (i_file, i_chunk)
+            for i_file, file in enumerate(self.manifest["files"])
+            for i_chunk in range(len(file["chunks"]))
+        ]
+
+    def chunk_size(self, i_file, i_chunk):
+        size = self.manifest["files"][i_file]["size"]
+        return min(self.chunk_bytes, size - i_chunk * self.chunk_bytes)
+
+    def file_path(self, i_file):
+        return os.path.join(self.root, self.manifest["files"][i_file]["path"])
+
+    def load_journal(self):
+        if not os.path.exists(self.journal_filename):
+            return set()
+        with open(self.journal_filename) as f:
+            return {tuple(int(field) for field in line.split()) for line in f if len(line.split()) == 2}
+
+    def prepare_files(self):
+        for directory in self.manifest["directories"]:
+            os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+        for i_file, file in enumerate(self.manifest["files"]):
+            path = self.file_path(i_file)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "ab"):
+                pass
+            if os.path.getsize(path) != file["size"]:
+                os.truncate(path, file["size"])
+
+    def mark_done(self, chunk, journal_file):
+        if journal_file is not None:
+            journal_file.write(f"{chunk[0]} {chunk[1]}\n")
+            journal_file.flush()
+        with self.condition:
+            self.done.add(chunk)
+            self.condition.notify_all()
+
+    def read_chunk(self, i_file, i_chunk):
+        with self.condition:
+            self.condition.wait_for(lambda: (i_file, i_chunk) in self.done)
+        with open(self.file_path(i_file), "rb") as f:
+            return os.pread(f.fileno(), self.chunk_size(i_file, i_chunk), i_chunk * self.chunk_bytes)
+
+    def serve_connection(self, connection):
+        with connection:
+            while (line := receive_line(connection)) is not None:
+                if line == "DONE":
+                    with self.condition:
+                        self.children_done += 1
+                        self.condition.notify_all()
+                    return
+                _, i_file, i_chunk = line.split()
+                data = self.read_chunk(int(i_file), int(i_chunk))
+                connection.sendall(struct.pack("!Q", len(data)) + data)
+
+    def serve(self, port):
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("0.0.0.0", port))
+        listener.listen(64)
+        while True:
+            connection, _ = listener.accept()
+            threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+
+    def connect(self, parent_host, parent_port):
+        deadline = time.monotonic() + CONNECT_RETRY_SECONDS
+        while True:
+            try:
+                connection = socket.create_connection((parent_host, parent_port), timeout=600)
+                connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return connection
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.2)
+
+    def pull(self, parent_host, parent_port, missing_chunks, lock, journal_file, received):
+        """
+        Pulls chunks from the shared list until it is empty, reconnecting if the connection drops.
+        """
+
+        connection = self.connect(parent_host, parent_port)
+        while True:
+            with lock:
+                if len(missing_chunks) == 0:
+                    break
+                i_file, i_chunk = missing_chunks.pop(0)
+            expected_hash = self.manifest["files"][i_file]["chunks"][i_chunk]
+            for attempt in range(MAX_CHUNK_ATTEMPTS):
+                try:
+                    connection.sendall(f"GET {i_file} {i_chunk}\n".encode())
+                    (size,) = struct.unpack("!Q", receive_exactly(connection, 8))
+                    data = receive_exactly(connection, size)
+                except OSError:
+                    connection.close()
+                    connection = self.connect(parent_host, parent_port)
+                    continue
+                if hashlib.sha256(data).hexdigest() == expected_hash:
+                    break
+            else:
+                raise RuntimeError(f"Chunk {i_chunk} of {self.file_path(i_file)} failed its checksum {MAX_CHUNK_ATTEMPTS} times.")
+            with open(self.file_path(i_file), "r+b") as f:
+                os.pwrite(f.fileno(), data, i_chunk * self.chunk_bytes)
+            with lock:
+                received[0] += len(data)
+            self.mark_done((i_file, i_chunk), journal_file)
+        connection.close()
+
+    def run(self, port, parent, n_streams, timeout_seconds):
+        start_time = time.monotonic()
+        if parent is None:
+            self.done = set(self.all_chunks())
+        else:
+            self.prepare_files()
+            self.done = self.load_journal() & set(self.all_chunks())
+        resumed_bytes = sum(self.chunk_size(*chunk) for chunk in self.done) if parent is not None else 0
+
+        threading.Thread(target=self.serve, args=(port,), daemon=True).start()
+
+        received = [0]
+        pull_start_time = time.monotonic()
+        if parent is not None:
+            parent_host, parent_port = parent.rsplit(":", 1)
+            missing_chunks = [chunk for chunk in self.all_chunks() if chunk not in self.done]
+            lock = threading.Lock()
+            errors = []
+            with open(self.journal_filename, "a") as journal_file:
+
+                def pull():
+                    try:
+                        self.pull(parent_host, int(parent_port), missing_chunks, lock, journal_file, received)
+                    except Exception as e:
+                        errors.append(e)
+
+                threads = [threading.Thread(target=pull) for _ in range(n_streams)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            if errors:
+                raise errors[0]
+            for i_file, file in enumerate(self.manifest["files"]):
+                os.chmod(self.file_path(i_file), file["mode"])
+            with self.condition:
+                assert self.done == set(self.all_chunks()), "Some chunks are missing."
+            with self.connect(parent_host, int(parent_port)) as connection:
+                connection.sendall(b"DONE\n")
+        pull_seconds = time.monotonic() - pull_start_time
+        with open(self.complete_filename, "w") as f:
+            f.write(f"{time.time()}\n")
+        finish_time = time.time()
+
+        with self.condition:
+            children_finished = self.condition.wait_for(
+                lambda: self.children_done >= self.n_children,
+                timeout=max(0.0, timeout_seconds - (time.monotonic() - start_time)),
+            )
+
+        print(
+            RESULT_PREFIX
+            + json.dumps(
+                {
+                    "received_bytes": received[0],
+                    "resumed_bytes": resumed_bytes,
+                    "total_bytes": sum(file["size"] for file in self.manifest["files"]),
+                    "pull_seconds": pull_seconds,
+                    "gbps": received[0] * 8 / 1e9 / max(pull_seconds, 1e-9),
+                    "finish_time": finish_time,
+                    "children_finished": children_finished,
+                }
+            ),
+            flush=True,
+        )
+        # unfinished children are in the result, which stage.py reports for every node with how to resume
+        return 0
+
+
+def main(arguments):
+    mode, arguments = arguments[0], arguments[1:]
+    if mode == "manifest":
+        print(json.dumps(get_manifest(arguments[0], int(arguments[1]))))
+        return 0
+    if mode == "relay":
+        root, manifest_filename, port, parent, n_children, n_streams, timeout_seconds = arguments
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+        return Relay(root, manifest, int(n_children)).run(
+            port=int(port),
+            parent=None if parent == "-" else parent,
+            n_streams=int(n_streams),
+            timeout_seconds=float(timeout_seconds),
+        )
+    raise ValueError(f"Unknown mode {mode!r}.")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -58,26 +58,8 @@ if [ -z "$GITHUB_REPO" ]; then
   exit 1
 fi
 
-# Select the appropriate YAML file based on number of nodes
-case $NODES in
-  1)
-    YAML_FILE="ssh_pod_1_nodes.yaml"
-    ;;
-  2)
-    YAML_FILE="ssh_pod_2_nodes.yaml"
-    ;;
-  4)
-    YAML_FILE="ssh_pod_4_nodes.yaml"
-    ;;
-  *)
-    echo "Error: Unsupported number of nodes: $NODES"
-    echo "Supported values are: 1, 2, 4"
-    exit 1
-    ;;
-esac
-
 # Build the command
-CMD="uv run setup.py --kubernetes-config-filename $YAML_FILE --github-repo $GITHUB_REPO"
+CMD="uv run setup.py --nodes $NODES --github-repo $GITHUB_REPO"
 
 # Add optional arguments if provided
 if [ ! -z "$GITHUB_BRANCH" ]; then
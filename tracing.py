@@ -0,0 +1,257 @@
+import os
+import json
+import threading
+from time import time
+from datetime import datetime
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+from beartype import beartype
+
+
+TRACE_DIRECTORY: str = os.path.join(".sfcompute", "traces")
+
+# spans are only recorded once `enable` is called, so that tracing costs nothing by default
+enabled: bool = False
+spans: list["Span"] = []
+spans_lock = threading.Lock()
+# the pod the current thread is working on, see `pod_context`
+thread_state = threading.local()
+
+
+@beartype
+@dataclass(frozen=True)
+class Span:
+    name: str
+    # "phase" for the phases of setup.py's main, "task" for the steps of setup.py's main which are about one pod,
+    # "command" for local commands, "step" for steps of remote scripts and "wait" for time spent waiting on something
+    # outside of our control
+    category: str
+    # seconds since the epoch, since the steps of remote scripts are timed with the pods' clocks
+    start_time: float
+    end_time: float
+    # None for spans which are not about a single pod
+    pod: str | None
+    # the thread the span was recorded on, used to lay out spans which are not about a single pod
+    thread: str
+    exit_code: int | None = None
+
+    @property
+    def duration_seconds(self) -> float:
+        return self.end_time - self.start_time
+
+
+@beartype
+@dataclass(frozen=True)
+class CriticalPathEntry:
+    phase: Span
+    # the pod which finished last during the phase, None if no span during the phase is about a pod
+    pod: str | None
+    # what the pod did during the phase, its remote script steps if it ran any and its commands otherwise
+    spans: list[Span]
+
+
+@beartype
+def enable() -> None:
+    global enabled
+    enabled = True
+
+
+@beartype
+def get_current_pod() -> str | None:
+    return getattr(thread_state, "pod", None)
+
+
+@contextmanager
+def pod_context(pod: str) -> Iterator[None]:
+    """
+    Attributes the spans recorded by the current thread to `pod`.
+    """
+
+    previous_pod = get_current_pod()
+    thread_state.pod = pod
+    try:
+        yield
+    finally:
+        thread_state.pod = previous_pod
+
+
+@beartype
+def record_span(
+    name: str,
+    category: str,
+    start_time: float,
+    end_time: float,
+    pod: str | None = None,
+    exit_code: int | None = None,
+) -> None:
+    if not enabled:
+        return
+    with spans_lock:
+        spans.append(
+            Span(
+                name=name,
+                category=category,
+                start_time=start_time,
+                end_time=end_time,
+                pod=pod,
+                thread=threading.current_thread().name,
+                exit_code=exit_code,
+            )
+        )
+
+
+@contextmanager
+def span(name: str, category: str = "phase", pod: str | None = None) -> Iterator[None]:
+    """
+    Records a span around the body of the `with` statement, with exit code 1 if it raises.
+    """
+
+    start_time = time()
+    exit_code = 1
+    try:
+        yield
+        exit_code = 0
+    finally:
+        record_span(name, category, start_time, time(), pod=pod, exit_code=exit_code)
+
+
+@beartype
+def get_lane(span: Span) -> str:
+    return span.pod if span.pod is not None else span.thread
+
+
+@beartype
+def to_chrome_trace(spans: list[Span]) -> dict:
+    """
+    The Chrome trace event format, which Perfetto (https://ui.perfetto.dev) and chrome://tracing open.
+    There is one row per pod, and one per thread for the spans which are not about a pod.
+    """
+
+    if len(spans) == 0:
+        return {"traceEvents": [], "displayTimeUnit": "ms"}
+
+    origin = min(span.start_time for span in spans)
+    lanes = sorted({get_lane(span) for span in spans}, key=lambda lane: (lane != "MainThread", lane))
+    lane_ids = {lane: i for i, lane in enumerate(lanes)}
+
+    events: list[dict] = [
+        {"name": "thread_name", "ph": "M", "pid": 1, "tid": lane_ids[lane], "args": {"name": lane}}
+        for lane in lanes
+    ]
+    # enclosing spans first, so that viewers nest spans which start at the same time correctly
+    for span in sorted(spans, key=lambda span: (span.start_time, -span.end_time)):
+        events.append(
+            {
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "pid": 1,
+                "tid": lane_ids[get_lane(span)],
+                "ts": (span.start_time - origin) * 1e6,
+                "dur": max(span.duration_seconds, 0.0) * 1e6,
+                "args": {"pod": span.pod, "exit_code": span.exit_code},
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+@beartype
+def find_critical_path(spans: list[Span]) -> list[CriticalPathEntry]:
+    """
+    The phases of setup.py run one after the other, and within a phase the pods work concurrently,
+    so the critical path goes through the pod which finished last in each phase.
+    """
+
+    phases = sorted(
+        [span for span in spans if span.category == "phase" and span.pod is None],
+        key=lambda span: span.start_time,
+    )
+    # only the innermost phases, since the outermost one covers the whole run
+    phases = [
+        phase
+        for phase in phases
+        if not any(
+            other is not phase
+            and phase.start_time <= other.start_time
+            and other.end_time <= phase.end_time
+            for other in phases
+        )
+    ]
+
+    critical_path: list[CriticalPathEntry] = []
+    for phase in phases:
+        pod_spans = [
+            span
+            for span in spans
+            if span.pod is not None
+            and span.category != "phase"
+            and phase.start_time <= span.start_time <= phase.end_time
+        ]
+        if len(pod_spans) == 0:
+            critical_path.append(CriticalPathEntry(phase=phase, pod=None, spans=[]))
+            continue
+        critical_pod = max(pod_spans, key=lambda span: span.end_time).pod
+        critical_pod_spans = [span for span in pod_spans if span.pod == critical_pod]
+        steps = [span for span in critical_pod_spans if span.category == "step"]
+        critical_path.append(
+            CriticalPathEntry(
+                phase=phase,
+                pod=critical_pod,
+                spans=sorted(
+                    steps if len(steps) > 0 else critical_pod_spans,
+                    key=lambda span: span.start_time,
+                ),
+            )
+        )
+    return critical_path
+
+
+@beartype
+def format_summary(spans: list[Span]) -> str:
+    if len(spans) == 0:
+        return "NO SPANS WERE RECORDED"
+
+    total_seconds = max(span.end_time for span in spans) - min(span.start_time for span in spans)
+    lines: list[str] = [f"=== CRITICAL PATH, {total_seconds:.1f}s IN TOTAL ==="]
+    for entry in find_critical_path(spans):
+        lines.append(
+            f"{entry.phase.name:<40} {entry.phase.duration_seconds:8.1f}s {100 * entry.phase.duration_seconds / max(total_seconds, 1e-9):5.1f}%"
+            + (f"  SLOWEST POD {entry.pod}" if entry.pod is not None else "")
+        )
+        for span in entry.spans:
+            exit_code = f" EXIT CODE {span.exit_code}" if span.exit_code not in [None, 0] else ""
+            lines.append(f"    {span.name[:80]:<80} {span.duration_seconds:8.1f}s{exit_code}")
+
+    step_durations: dict[str, list[float]] = {}
+    for span in spans:
+        if span.category in ["step", "wait"] and span.pod is not None:
+            step_durations.setdefault(span.name, []).append(span.duration_seconds)
+    if len(step_durations) > 0:
+        name_width = max(len(name) for name in step_durations)
+        lines.append("=== STEPS ACROSS PODS ===")
+        lines.append(f"{'STEP':<{name_width}} {'PODS':>5} {'MIN':>9} {'MAX':>9}")
+        for name, durations in step_durations.items():
+            lines.append(
+                f"{name:<{name_width}} {len(durations):>5} {min(durations):8.1f}s {max(durations):8.1f}s"
+            )
+    return "\n".join(lines)
+
+
+@beartype
+def write_trace(directory: str = TRACE_DIRECTORY) -> tuple[str, str]:
+    """
+    Writes the spans recorded so far as a Chrome trace and as a summary table.
+    Returns the filenames of both.
+    """
+
+    with spans_lock:
+        recorded_spans = list(spans)
+
+    os.makedirs(directory, exist_ok=True)
+    basename = os.path.join(directory, f"trace-{datetime.now().strftime('%Y%m%d-%H%M%S')}")
+    with open(basename + ".json", "w") as f:
+        json.dump(to_chrome_trace(recorded_spans), f)
+    with open(basename + ".txt", "w") as f:
+        f.write(format_summary(recorded_spans) + "\n")
+    return basename + ".json", basename + ".txt"